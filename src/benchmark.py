@@ -0,0 +1,223 @@
+import argparse
+import logging
+import os
+import tempfile
+import time
+from typing import Callable, Tuple
+
+import cv2
+import numpy as np
+
+from main import IMKReader
+from reader import SCORING
+from utils import reader_utils
+from utils.console import logger
+from utils.profiling import StageTimer
+from utils.sheet_generator import generate_sheet, random_answers
+
+
+def score_with_loop(
+    img: np.ndarray, n_rows: int, n_cols: int, min_pixel: int = 300
+) -> Tuple[np.ndarray, np.ndarray]:
+    boxes = reader_utils.splitBoxes(img, n_rows, n_cols)
+    scores = np.zeros((n_rows, n_cols), dtype=int)
+    pixVal = np.zeros((n_rows, n_cols), dtype=int)
+
+    for i, row in enumerate(boxes):
+        for j, col in enumerate(row):
+            blackened = cv2.countNonZero(col)
+            scores[i, j] = 1 if blackened >= min_pixel else 0
+            pixVal[i, j] = blackened
+
+    return scores, pixVal
+
+
+def time_per_call(fn: Callable, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_scoring(n_rows: int = 32, n_cols: int = 23, repeat: int = 200) -> None:
+    warpH, warpW = 297 * 3, 210 * 3
+    warpH = warpH - (warpH % n_rows)
+    warpW = warpW - (warpW % n_cols)
+
+    rng = np.random.default_rng(0)
+    imgThresh = np.where(rng.random((warpH, warpW)) < 0.3, 255, 0).astype(np.uint8)
+
+    loop_scores, loop_pixVal = score_with_loop(imgThresh, n_rows, n_cols)
+    grid_scores, grid_pixVal = reader_utils.scoreGrid(imgThresh, n_rows, n_cols)
+    assert np.array_equal(loop_scores, grid_scores)
+    assert np.array_equal(loop_pixVal, grid_pixVal)
+
+    loop_time = time_per_call(
+        lambda: score_with_loop(imgThresh, n_rows, n_cols), repeat
+    )
+    grid_time = time_per_call(
+        lambda: reader_utils.scoreGrid(imgThresh, n_rows, n_cols), repeat
+    )
+    logger.info(f"Grid scoring ({n_rows}x{n_cols} cells, {warpW}x{warpH} image)")
+    logger.info(f"  countNonZero loop: {loop_time * 1000:.3f} ms/sheet")
+    logger.info(f"  scoreGrid:         {grid_time * 1000:.3f} ms/sheet")
+    logger.info(f"  speedup:           {loop_time / grid_time:.1f}x")
+
+
+def bench_pipeline(
+    n_sheets: int = 20,
+    dpi: int = 300,
+    rotation: float = 1.0,
+    skew: float = 0.01,
+    noise: float = 4.0,
+    seed: int = 0,
+    scoring: str = "global",
+) -> None:
+    timer = StageTimer()
+    imk = IMKReader(timer=timer, scoring=scoring)
+    rng = np.random.default_rng(seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filenames, truths = [], []
+        for i in range(n_sheets):
+            truth = random_answers(
+                imk.reader.n_rows,
+                imk.reader.n_cols,
+                imk.drop_row,
+                imk.drop_col,
+                rng,
+                blank_rate=0.02,
+                double_rate=0.02,
+            )
+            img = generate_sheet(
+                truth,
+                imk.drop_row,
+                imk.drop_col,
+                dpi=dpi,
+                rotation=rng.uniform(-rotation, rotation),
+                skew=skew,
+                noise=noise,
+                rng=rng,
+            )
+            filename = os.path.join(tmp, f"sheet_{i:04d}.jpg")
+            cv2.imwrite(filename, img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+            filenames.append(filename)
+            truths.append(truth)
+
+        # The per-question logging of the decoder is not part of the benchmark
+        level = logger.level
+        logger.setLevel(logging.WARNING)
+        try:
+            start = time.perf_counter()
+            answers = [imk.reader.read(filename) for filename in filenames]
+            read_time = time.perf_counter() - start
+
+            # Same sheets again, with decoding overlapped with the processing
+            start = time.perf_counter()
+            prefetched = list(imk.reader.read_many(filenames))
+            read_many_time = time.perf_counter() - start
+            assert all(
+                isinstance(a, str) or np.array_equal(a, b)
+                for a, b in zip(answers, prefetched)
+            )
+
+            # Decoded full resolution images skip the decode reduction, so the
+            # detection image is shrunk at the full scan ratio, 5x at 600 dpi
+            images = [cv2.imread(f, cv2.IMREAD_GRAYSCALE) for f in filenames]
+            full_reader = IMKReader(scoring=scoring).reader
+            start = time.perf_counter()
+            full_answers = list(full_reader.read_many(images))
+            full_time = time.perf_counter() - start
+            del images
+
+            grids = [a for a in answers if not isinstance(a, str)]
+            start = time.perf_counter()
+            for answer in grids:
+                imk.decode(answer)
+            decode_time = time.perf_counter() - start
+
+            def count_matched(results) -> int:
+                return sum(
+                    not isinstance(answer, str)
+                    and imk.decode(answer) == imk.decode(truth)
+                    for answer, truth in zip(results, truths)
+                )
+
+            matched = count_matched(answers)
+            full_matched = count_matched(full_answers)
+        finally:
+            logger.setLevel(level)
+
+    total_time = read_time + decode_time
+    height, width = img.shape[:2]
+    logger.info(
+        f"Pipeline ({n_sheets} sheets, {width}x{height} at {dpi} dpi, "
+        f"rotation ±{rotation}°, skew {skew}, noise {noise}, {scoring} scoring)"
+    )
+    logger.info(f"  Reader.read:     {read_time / n_sheets * 1000:.1f} ms/sheet")
+    logger.info(f"  Reader.read_many: {read_many_time / n_sheets * 1000:.1f} ms/sheet")
+    logger.info(f"  full resolution: {full_time / n_sheets * 1000:.1f} ms/sheet")
+    logger.info(f"  IMKReader.decode: {decode_time / n_sheets * 1000:.3f} ms/sheet")
+    logger.info(f"  throughput:      {n_sheets / total_time:.1f} sheets/s")
+    logger.info(f"  read failures:   {n_sheets - len(grids)}")
+    logger.info(f"  correct sheets:  {matched}/{n_sheets}")
+    logger.info(f"  correct at full resolution: {full_matched}/{n_sheets}")
+    timer.log_summary()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--suite",
+        choices=["scoring", "pipeline", "all"],
+        default="all",
+        help="Benchmark to run",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=200, help="Number of timed runs per method"
+    )
+    parser.add_argument(
+        "--sheets", type=int, default=20, help="Number of synthetic sheets"
+    )
+    parser.add_argument("--dpi", type=int, default=300, help="Scan resolution")
+    parser.add_argument(
+        "--rotation", type=float, default=1.0, help="Maximum rotation in degrees"
+    )
+    parser.add_argument(
+        "--skew",
+        type=float,
+        default=0.01,
+        help="Maximum corner displacement as a fraction of the page width",
+    )
+    parser.add_argument(
+        "--noise", type=float, default=4.0, help="Standard deviation of pixel noise"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument(
+        "--scoring",
+        choices=list(SCORING),
+        default="global",
+        help="Bubble scoring of the pipeline benchmark",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def main() -> None:
+    args = parse_args()
+    if args.suite in ["scoring", "all"]:
+        bench_scoring(repeat=args.repeat)
+    if args.suite in ["pipeline", "all"]:
+        bench_pipeline(
+            n_sheets=args.sheets,
+            dpi=args.dpi,
+            rotation=args.rotation,
+            skew=args.skew,
+            noise=args.noise,
+            seed=args.seed,
+            scoring=args.scoring,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,136 @@
+import argparse
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import List, Set, Tuple
+from urllib.parse import urljoin
 
+import lxml.html
 import pandas as pd
-from bs4 import BeautifulSoup
+import requests
 from rich.progress import track
 
-from utils import create_session
+from utils import BASE_URL, create_session, pool_session
+from utils.console import logger
+
+DATABASE_PATH = "../data/database/student_links.csv"
+
+page_pattrn = re.compile(r"start=\d*")
+sid_pattrn = re.compile(r"idmurid=(\d+)")
+
+
+def find_links(html: str, pattern: re.Pattern) -> List[Tuple[str, str]]:
+    # lxml only builds the tree, which is all that is needed to list anchors
+    if not html.strip():
+        return []
+    anchors = lxml.html.fromstring(html).xpath("//a[@href]")
+    return [
+        (anchor.get("href"), anchor.text_content().strip())
+        for anchor in anchors
+        if pattern.search(anchor.get("href"))
+    ]
+
+
+def fetch_links(
+    session: requests.Session, url: str, timeout: float = 30.0
+) -> List[Tuple[str, str]]:
+    resp = session.get(url, timeout=timeout)
+    resp.raise_for_status()
+    return find_links(resp.text, sid_pattrn)
+
+
+def crawl(
+    session: requests.Session, url_index: str, workers: int = 8
+) -> Set[Tuple[str, str]]:
+    html = session.get(f"{url_index}?page=3", timeout=30.0)
+    html.raise_for_status()
+    pages = [urljoin(url_index, page) for page, _ in find_links(html.text, page_pattrn)]
+    pages = list(dict.fromkeys(pages))
+
+    # Pages are fetched by a bounded pool of threads sharing one connection
+    # pool, a page that still fails after its retries is skipped and reported
+    full_links = set()
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch_links, session, page) for page in pages]
+        for future in track(
+            as_completed(futures), total=len(futures), description="Crawling..."
+        ):
+            try:
+                full_links.update(future.result())
+            except requests.RequestException as e:
+                failed += 1
+                logger.warning(f"Skipping page: {e}")
+    if failed > 0:
+        logger.error(f"{failed} of {len(pages)} pages could not be fetched.")
+    return full_links
+
+
+def merge_links(links: Set[Tuple[str, str]], path: str = DATABASE_PATH) -> pd.DataFrame:
+    # Every link is kept with the student name it is shown under, which is what
+    # graded sheets are matched on when they are uploaded
+    df = pd.DataFrame(sorted(links), columns=["link", "NAMA"])
+    df.insert(0, "ID", df["link"].str.extract(sid_pattrn, expand=False))
+    df = df[df["ID"].str.len() > 0].astype({"ID": int})
+    df = df.drop_duplicates(subset="ID").set_index("ID")
+
+    # Students already in the database keep their rows, only new ones are added
+    # and a name or link the database is missing is taken from the fresh crawl
+    if os.path.exists(path):
+        old_df = pd.read_csv(path).drop_duplicates(subset="ID").set_index("ID")
+        added = (~df.index.isin(old_df.index)).sum()
+        columns = list(dict.fromkeys([*old_df.columns, *df.columns]))
+        df = old_df.combine_first(df)[columns]
+        logger.info(f"Added {added} new students to {len(old_df)} known.")
+    df = df.sort_index().reset_index()
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    tmp = f"{path}.tmp"
+    df.to_csv(tmp, index=False)
+    os.replace(tmp, path)
+    return df
 
 
 def main():
-    url_index = "https://epkm.moe.gov.my/guru/index.php"
-    session = create_session()
-    html = session.get(f"{url_index}?page=3")
-    soup = BeautifulSoup(html.text, "html.parser")
-    pages = soup.find_all("a", href=re.compile(r"start=\d*"))
-    pages = [page["href"] for page in pages]
-
-    link_pattrn = re.compile("idmurid")
-    full_links = []
-    for page in track(pages):
-        resp = session.get(f"{url_index}{page}")
-        soup = BeautifulSoup(resp.text, "html.parser")
-        links = soup.find_all("a", href=link_pattrn)
-        full_links.extend([link["href"] for link in links])
-    full_links = list(set(full_links))
-
-    df = []
-    sid_pattrn = re.compile(r"idmurid=(\d*)")
-
-    for link in full_links:
-        sid = sid_pattrn.search(link).group(1)
-        df.append({"ID": int(sid), "link": link})
-    df = pd.DataFrame(df, columns=["ID", "link"])
-    df.sort_values(by="ID", inplace=True)
-    df.reset_index(inplace=True, drop=True)
-    df.to_csv("../data/database/student_links.csv", index=False)
+    parser = argparse.ArgumentParser(
+        description="Build the database of student links from SEPKM"
+    )
+    parser.add_argument(
+        "--base-url",
+        type=str,
+        default=BASE_URL,
+        help="SEPKM server to crawl, a local stand-in can be used for testing",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=DATABASE_PATH,
+        help="CSV file of student links, new students are merged into it",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of pages fetched at the same time",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="Number of retries of a failed request, with exponential backoff",
+    )
+    args = parser.parse_args()
+
+    session = create_session(args.base_url)
+    if session is None:
+        logger.error("Unable to log in to SEPKM.")
+        return
+    pool_session(session, pool_size=args.workers, retries=args.retries)
+
+    links = crawl(session, f"{args.base_url}/guru/index.php", workers=args.workers)
+    df = merge_links(links, args.output)
+    logger.info(f"{len(df)} students in {args.output}.")
 
 
 if __name__ == "__main__":
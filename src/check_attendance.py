@@ -3,65 +3,11 @@ import os
 import sys
 from datetime import datetime
 
-import matplotlib.pyplot as plt
-import numpy as np
 import pandas as pd
 import streamlit as st
 from streamlit import cli as stcli
 
-from utils import fix_ic, forms2int, validate_name
-
-
-INV_MAPPINGS = {
-    "IMK": ["1", "3"],
-    "IKP": ["3"],
-    "ITP 1": ["1"],
-    "ITP 4": ["4"],
-}
-
-
-def pie_label(pct, allvals):
-    absolute = int(round(pct / 100.0 * np.sum(allvals)))
-    return absolute
-
-
-@st.cache(allow_output_mutation=True)
-def load_main_df(df_main, inv_type: str) -> pd.DataFrame:
-    filters = "|".join(INV_MAPPINGS[inv_type])
-    df_main = pd.read_excel(
-        df_main,
-        converters={
-            "Keterangan Tingkatan Tahun": forms2int,
-            "No. KP": fix_ic,
-            "No. Tel Bimbit Penjaga 1": str,
-            "No. Tel Bimbit Penjaga 2": str,
-        },
-    )
-    df_main = df_main[df_main["Keterangan Tingkatan Tahun"].str.contains(filters)]
-    return df_main
-
-
-@st.cache
-def load_attendance_df(df_attendance, inv_type: str) -> pd.DataFrame:
-    df_attendance: pd.DataFrame = pd.read_excel(
-        df_attendance,
-        converters={"NO. KAD PENGENALAN": fix_ic},
-    )
-    df_attendance.dropna(
-        axis=0,
-        how="any",
-        subset=["NAMA", "TINGKATAN", "NO. KAD PENGENALAN"],
-        inplace=True,
-    )
-    df_attendance = validate_name(df_attendance)
-    return df_attendance
-
-
-@st.cache
-def filter_df(df: pd.DataFrame, s: str):
-    filters = "|".join(INV_MAPPINGS[s])
-    df = df[df["Keterangan Tingkatan Tahun"].str.contains(filters)]
-    return df
+from utils.attendance import INV_MAPPINGS, Upload, match_attendance, pie_chart
 
 
 def main():
@@ -84,13 +30,7 @@ def main():
     if df_main is None or df_attendance is None:
         st.stop()
 
-    df_main = load_main_df(df_main, inv_type)
-    df_attendance = load_attendance_df(df_attendance, inv_type)
-
-    df_main["ADA NAMA"] = df_main["Nama"].isin(df_attendance["NAMA"])
-    df_main["ADA KP"] = df_main["No. KP"].isin(df_attendance["NO. KAD PENGENALAN"])
-    df_main["JAWAP"] = df_main["ADA NAMA"] | df_main["ADA KP"]
-    df_main.drop(["ADA NAMA", "ADA KP"], axis=1, inplace=True)
+    df_main = match_attendance(Upload(df_main), Upload(df_attendance), inv_type)
 
     forms = df_main["Keterangan Tingkatan Tahun"].unique()
     forms.sort()
@@ -100,11 +40,11 @@ def main():
     selected_forms = st.selectbox("Tingkatan", forms)
     selected_classes = st.multiselect("Kelas", classes, default=classes)
     selected_classes.sort()
-    selected_classes = "|".join(selected_classes)
 
-    df_filtered = df_main[df_main["Nama Kelas"].str.contains(selected_classes)]
-    df_filtered = df_filtered[
-        df_filtered["Keterangan Tingkatan Tahun"].str.contains(selected_forms)
+    # Classes are matched exactly, "1 A" must not also pick up "1 AB"
+    df_filtered = df_main[
+        df_main["Nama Kelas"].isin(selected_classes)
+        & (df_main["Keterangan Tingkatan Tahun"] == selected_forms)
     ]
 
     df_show = df_filtered[~df_filtered.JAWAP].sort_values("Nama Kelas")
@@ -121,22 +61,16 @@ def main():
             df_show.to_excel(writer, index=False)
         st.success(f"Telah muat turun di {os.path.abspath(outputfile)}")
 
+    # Answered and total students of every selected class in one pass
+    counts = (
+        df_filtered.groupby("Nama Kelas")["JAWAP"]
+        .agg(["sum", "size"])
+        .reindex(selected_classes, fill_value=0)
+    )
     cols = itertools.cycle(st.columns(4))
-    for cls in selected_classes.split("|"):
-        df_tmp = df_filtered[df_filtered["Nama Kelas"].str.contains(cls)]
-        present = df_tmp.JAWAP.eq(True).astype(int).sum()
-        absent = df_tmp.JAWAP.eq(False).astype(int).sum()
-        fig, ax = plt.subplots()
-        plt.title(f"{selected_forms} {cls}")
-        ax.axis("equal")
-        ax.pie(
-            [present, absent],
-            labels=["Dah Jawap", "Belum Jawap"],
-            autopct=lambda pct: pie_label(pct, [present, absent]),
-            startangle=90,
-            colors=["#4daf4a", "#e41a1c"],
-        )
-        next(cols).pyplot(fig)
+    for cls, present, total in counts.itertuples():
+        png = pie_chart(f"{selected_forms} {cls}", int(present), int(total - present))
+        next(cols).image(png)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,145 @@
+from dataclasses import asdict, dataclass, field
+from functools import cached_property
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+
+class Scores(NamedTuple):
+    scores: np.ndarray
+    no_answer: np.ndarray
+    two_answer: np.ndarray
+    review: np.ndarray
+
+
+@dataclass(frozen=True)
+class Layout:
+    paper: str
+    n_rows: int
+    n_cols: int
+    drop_rows: Tuple[int, ...] = ()
+    drop_cols: Tuple[int, ...] = ()
+    # Bubbles of one question sit next to each other on a row
+    choices: int = 2
+    # Questions are numbered down each column of a block of rows, then the
+    # next block below it, 0 means all rows are one block
+    block_rows: int = 0
+    first_question: int = 1
+    # Points for each choice of a question with exactly one bubble filled
+    choice_points: Tuple[int, ...] = (1, 0)
+    # Question numbers that are added up into each category
+    categories: Dict[str, Tuple[int, ...]] = field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, layout: dict) -> "Layout":
+        layout = dict(layout)
+        for key in ["drop_rows", "drop_cols", "choice_points"]:
+            if key in layout:
+                layout[key] = tuple(layout[key])
+        if "categories" in layout:
+            layout["categories"] = {
+                name: tuple(questions)
+                for name, questions in layout["categories"].items()
+            }
+        return cls(**layout)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @cached_property
+    def compiled(self) -> "CompiledLayout":
+        return CompiledLayout(self)
+
+
+class CompiledLayout:
+    # Everything a sheet needs is turned into index arrays once per layout, so
+    # scoring a sheet is a handful of array operations
+    def __init__(self, layout: Layout):
+        self.layout = layout
+        self.keep_rows = np.setdiff1d(np.arange(layout.n_rows), layout.drop_rows)
+        self.keep_cols = np.setdiff1d(np.arange(layout.n_cols), layout.drop_cols)
+        if len(self.keep_cols) % layout.choices != 0:
+            raise ValueError(
+                f"{layout.paper}: {len(self.keep_cols)} answer columns cannot be "
+                f"grouped into questions of {layout.choices} choices."
+            )
+        if len(layout.choice_points) != layout.choices:
+            raise ValueError(
+                f"{layout.paper}: choice_points needs one value for each of the "
+                f"{layout.choices} choices."
+            )
+
+        n_rows = len(self.keep_rows)
+        n_groups = len(self.keep_cols) // layout.choices
+        block_rows = layout.block_rows or n_rows
+        if n_rows % block_rows != 0:
+            raise ValueError(
+                f"{layout.paper}: {n_rows} answer rows cannot be split into blocks "
+                f"of {block_rows} rows."
+            )
+        self.shape = (n_rows, n_groups, layout.choices)
+
+        idx_row, idx_group = np.mgrid[0:n_rows, 0:n_groups]
+        block, row = np.divmod(idx_row, block_rows)
+        self.question_num = (
+            layout.first_question
+            + block * block_rows * n_groups
+            + idx_group * block_rows
+            + row
+        )
+
+        # One-hot map from every question position to the category it scores in
+        position = {q: i for i, q in enumerate(self.question_num.ravel())}
+        self.category_map = np.zeros((n_rows * n_groups, len(layout.categories)), int)
+        for k, (name, questions) in enumerate(layout.categories.items()):
+            missing = set(questions) - position.keys()
+            if missing:
+                raise ValueError(
+                    f"{layout.paper}: category {name} refers to questions "
+                    f"{sorted(missing)} that are not on the sheet."
+                )
+            self.category_map[[position[q] for q in questions], k] = 1
+        self.choice_points = np.asarray(layout.choice_points)
+
+    def score(
+        self, answer: np.ndarray, uncertain: Optional[np.ndarray] = None
+    ) -> Scores:
+        # Trim to the answer bubbles and group them into (row, question, choice)
+        answer = answer[np.ix_(self.keep_rows, self.keep_cols)].reshape(self.shape)
+        filled = answer.sum(axis=2)
+        points = np.where(filled == 1, answer @ self.choice_points, 0)
+
+        # Questions with a bubble that could go either way are left for review,
+        # they are scored as read but not reported as blank or double
+        review = np.zeros(filled.shape, dtype=bool)
+        if uncertain is not None:
+            uncertain = uncertain[np.ix_(self.keep_rows, self.keep_cols)]
+            review = uncertain.reshape(self.shape).any(axis=2)
+        return Scores(
+            scores=points.ravel() @ self.category_map,
+            no_answer=self.question_num[(filled == 0) & ~review],
+            two_answer=self.question_num[(filled > 1) & ~review],
+            review=self.question_num[review],
+        )
+
+
+LAYOUTS = {
+    "IMK": Layout(
+        paper="IMK",
+        n_rows=32,
+        n_cols=23,
+        drop_rows=(10, 21),
+        drop_cols=(0, 3, 4, 7, 8, 11, 12, 15, 16, 19, 20),
+        choices=2,
+        block_rows=10,
+        choice_points=(1, 0),
+        categories={
+            "REALISTIK": (*range(1, 11), *range(61, 71), *range(121, 131)),
+            "INVESTIGATIF": (*range(11, 21), *range(71, 81), *range(131, 141)),
+            "ARTISTIK": (*range(21, 31), *range(81, 91), *range(141, 151)),
+            "SOSIAL": (*range(31, 41), *range(91, 101), *range(151, 161)),
+            "ENTERPRISING": (*range(41, 51), *range(101, 111), *range(161, 171)),
+            "KONVENSIONAL": (*range(51, 61), *range(111, 121), *range(171, 181)),
+        },
+    ),
+}
@@ -1,108 +1,362 @@
 import argparse
 import os
-from typing import Union
+import signal
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import chain, tee
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 
 from utils.console import logger
-from reader import Reader
-
-
-class IMKReader:
-    def __init__(self):
-        self.reader = Reader(n_rows=32, n_cols=23, debug=False)
-        self.drop_col = [0, 3, 4, 7, 8, 11, 12, 15, 16, 19, 20]
-        self.drop_row = [10, 21]
+from utils.pages import list_pages
+from utils.profiling import ProfileHook, StageTimer
+from utils.result_cache import ResultCache, file_digest
+from utils.result_writer import ResultWriter
+from layout import LAYOUTS
+from reader import SCORING, ImageSource, Reader
+
+
+class SheetReader:
+    paper = None
+
+    def __init__(
+        self,
+        timer: Optional[StageTimer] = None,
+        debug_dir: Optional[Union[str, os.PathLike]] = None,
+        scoring: str = "global",
+    ):
+        if self.paper not in LAYOUTS:
+            raise NotImplementedError(
+                f"No answer sheet layout is defined for {self.paper} yet."
+            )
+        self.layout = LAYOUTS[self.paper]
+        self.reader = Reader(
+            n_rows=self.layout.n_rows,
+            n_cols=self.layout.n_cols,
+            scoring=scoring,
+            timer=timer,
+            debug_dir=debug_dir,
+            debug=False,
+        )
+        self.drop_col = list(self.layout.drop_cols)
+        self.drop_row = list(self.layout.drop_rows)
         self.template_dict = {
-            "REALISTIK": 0,
-            "INVESTIGTIF": 0,
-            "ARTISTIK": 0,
-            "SOSIAL": 0,
-            "ENTERPRISING": 0,
-            "KONVENSIONAL": 0,
+            **{category: 0 for category in self.layout.categories},
             "REKOD": 0,
             "CATATAN": "",
         }
 
     def read_single_file(self, filename: Union[str, bytes, os.PathLike]) -> dict:
-        template_dict = self.template_dict.copy()
-        answer = self.reader.read(filename)
-
+        return self.to_result(filename, self.reader.read(filename))
+
+    def read_file(self, filename: str) -> Iterator[Tuple[int, dict]]:
+        # Multi-page scans yield one result per page, numbered from 1
+        pages = list_pages(filename)
+        for page, result in zip(pages, self.read_many(pages)):
+            yield page.number, result
+
+    def read_many(
+        self, sources: Iterable[ImageSource], prefetch: int = 4
+    ) -> Iterator[dict]:
+        # The reader runs at most prefetch items ahead, which bounds the tee
+        sources, ahead = tee(sources)
+        answers = self.reader.read_many(ahead, prefetch=prefetch)
+        for index, (source, answer) in enumerate(zip(sources, answers)):
+            yield self.to_result(self.reader.source_name(index, source), answer)
+
+    def to_result(
+        self, filename: Union[str, bytes, os.PathLike], answer: Union[np.ndarray, str]
+    ) -> dict:
         if isinstance(answer, str):
+            template_dict = self.template_dict.copy()
             template_dict.update(CATATAN=answer)
             return template_dict
 
-        answer = np.delete(answer, self.drop_col, axis=1)
-        answer = np.delete(answer, self.drop_row, axis=0)
-        scores = np.zeros((30, 6), dtype=int)
-        no_answer = []
-        two_answer = []
-
-        for idx_row, row in enumerate(answer, start=1):
-            pairs = np.hsplit(row, 6)
-            for idx_col, pair in enumerate(pairs):
-                question_num = (50 * ((idx_row - 1) // 10)) + (idx_col * 10) + idx_row
-                if sum(pair) == 0:
-                    logger.info(
-                        f"Question {question_num} has no answer or answer is unreadable."
-                    )
-                    no_answer.append(question_num)
-                elif sum(pair) == 2:
-                    logger.info(
-                        f"Question {question_num} has two answer or answer is unreadable."
-                    )
-                    two_answer.append(question_num)
-                else:
-                    scores[idx_row - 1, idx_col] = np.argmax(pair) ^ 1
-
-        scores = np.sum(scores, axis=0)
-
-        for key, score in zip(template_dict.keys(), scores):
-            template_dict[key] = score
+        template_dict = self.decode(answer, self.reader.uncertain)
+        # Sheets with blank, double or unsure answers get an overlay for review
+        if template_dict["CATATAN"]:
+            self.reader.dump_debug(filename, "flagged")
+        return template_dict
+
+    def decode(
+        self, answer: np.ndarray, uncertain: Optional[np.ndarray] = None
+    ) -> dict:
+        template_dict = self.template_dict.copy()
+
+        scores, no_answer, two_answer, review = self.layout.compiled.score(
+            answer, uncertain
+        )
+        for key, score in zip(self.layout.categories, scores):
+            template_dict[key] = int(score)
 
         if len(no_answer) > 0:
-            no_answer = map(lambda x: str(x), no_answer)
-            template_dict[
-                "CATATAN"
-            ] += f'Question {", ".join(no_answer)} has no answer.\n'
+            no_answer = ", ".join(map(str, no_answer))
+            logger.info(f"Question {no_answer} has no answer or answer is unreadable.")
+            template_dict["CATATAN"] += f"Question {no_answer} has no answer.\n"
 
         if len(two_answer) > 0:
-            two_answer = map(lambda x: str(x), two_answer)
-            template_dict[
-                "CATATAN"
-            ] += f'Question {", ".join(two_answer)} has no answer.\n'
+            two_answer = ", ".join(map(str, two_answer))
+            logger.info(
+                f"Question {two_answer} has two answer or answer is unreadable."
+            )
+            template_dict["CATATAN"] += f"Question {two_answer} has no answer.\n"
+
+        if len(review) > 0:
+            review = ", ".join(map(str, review))
+            logger.info(f"Question {review} is unclear and needs review.")
+            template_dict["CATATAN"] += f"Question {review} needs review.\n"
 
         template_dict.update(REKOD=1)
 
         return template_dict
 
+    def config(self) -> dict:
+        return {
+            "paper": self.paper,
+            **self.reader.config(),
+            "layout": self.layout.to_dict(),
+        }
 
-class IKKReader:
-    def __init__(self):
-        raise NotImplemented
-        # self.reader = Reader(n_rows=32, n_cols=23, debug=False)
-
-    # def read_single_file(
-    #     self, filename: Union[str, bytes, os.PathLike]
-    # ) -> Union[np.ndarray, None]:
-    #     answer = self.reader.read(filename)
-    #     logger.debug(answer)
-    #
-    #     return None
-
-
-class IKPReader:
-    def __init__(self):
-        raise NotImplemented
-        # self.reader = Reader(n_rows=32, n_cols=23, debug=False)
 
-    # def read_single_file(
-    #     self, filename: Union[str, bytes, os.PathLike]
-    # ) -> Union[np.ndarray, None]:
-    #     answer = self.reader.read(filename)
-    #     logger.debug(answer)
-    #
-    #     return None
+class IMKReader(SheetReader):
+    paper = "IMK"
+
+
+class IKKReader(SheetReader):
+    paper = "IKK"
+
+
+class IKPReader(SheetReader):
+    paper = "IKP"
+
+
+READERS = {"IMK": IMKReader, "IKK": IKKReader, "IKP": IKPReader}
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".pdf")
+
+# Results of one scan file, as (page number, result, stage timings) per page
+FileResults = List[Tuple[int, dict, Optional[Dict[str, float]]]]
+
+# Each worker process builds its own reader once and reuses it for every image
+_worker_reader = None
+
+
+def _init_worker(
+    paper: str,
+    timing: bool = False,
+    profile_dir: Optional[str] = None,
+    debug_dir: Optional[str] = None,
+    scoring: str = "global",
+) -> None:
+    global _worker_reader
+    # Ctrl+C and SIGTERM are handled by the main process, which lets running
+    # sheets finish, service managers often signal the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    timer = None
+    if timing or profile_dir is not None:
+        timer = StageTimer()
+        if profile_dir is not None:
+            timer.add_hook(ProfileHook(profile_dir))
+    _worker_reader = READERS[paper](timer=timer, debug_dir=debug_dir, scoring=scoring)
+
+
+def _read_in_worker(filename: str) -> FileResults:
+    # Stage timings are sent back so the main process can aggregate them
+    timer = _worker_reader.reader.timer
+    return [
+        (page, result, None if timer is None else dict(timer.last))
+        for page, result in _worker_reader.read_file(filename)
+    ]
+
+
+def _read_chunk_in_worker(filenames: List[str]) -> List[FileResults]:
+    # Within a chunk the next pages are decoded while the current one is graded,
+    # across file boundaries
+    timer = _worker_reader.reader.timer
+    pages = [page for filename in filenames for page in list_pages(filename)]
+    results = {filename: [] for filename in filenames}
+    for page, result in zip(pages, _worker_reader.read_many(pages)):
+        results[page.filename].append(
+            (page.number, result, None if timer is None else dict(timer.last))
+        )
+    return list(results.values())
+
+
+def list_images(path: Union[str, os.PathLike]) -> List[str]:
+    filenames = []
+    for root, _, files in os.walk(path):
+        for file in files:
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                filenames.append(os.path.join(root, file))
+    filenames.sort()
+    return filenames
+
+
+def read_directory(
+    paper: str,
+    path: Union[str, os.PathLike],
+    workers: Optional[int] = None,
+    cache: Optional[ResultCache] = None,
+    timer: Optional[StageTimer] = None,
+    profile_dir: Optional[str] = None,
+    debug_dir: Optional[str] = None,
+    scoring: str = "global",
+) -> Iterator[Tuple[str, int, dict]]:
+    filenames = list_images(path)
+    if len(filenames) == 0:
+        logger.warning(f'No images found in "{path}".')
+        return
+
+    # Only files that are new or changed since the last run are graded again
+    digests = {}
+    cached = {}
+    if cache is not None:
+        digests = {filename: file_digest(filename) for filename in filenames}
+        cache.evict(digests)
+        for filename, digest in digests.items():
+            results = cache.get(digest)
+            if results is not None:
+                cached[filename] = results
+    pending = [filename for filename in filenames if filename not in cached]
+
+    workers = workers or os.cpu_count() or 1
+    workers = max(1, min(workers, len(pending)))
+    chunksize = max(1, len(pending) // (workers * 4))
+
+    start = time.perf_counter()
+    n_sheets = 0
+    executor = None
+    file_results = iter([])
+    if len(pending) > 0:
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(paper, timer is not None, profile_dir, debug_dir, scoring),
+        )
+        chunks = [pending[i : i + chunksize] for i in range(0, len(pending), chunksize)]
+        file_results = chain.from_iterable(executor.map(_read_chunk_in_worker, chunks))
+    try:
+        for filename in filenames:
+            if filename in cached:
+                for page, result in enumerate(cached[filename], start=1):
+                    yield filename, page, result
+                continue
+            results = next(file_results)
+            for page, result, timings in results:
+                if timer is not None and timings is not None:
+                    timer.observe_sheet(timings)
+                n_sheets += 1
+                yield filename, page, result
+            # Sheets that could not be read are what a re-run should retry
+            if cache is not None and all(r["REKOD"] == 1 for _, r, _ in results):
+                cache.put(digests[filename], filename, [r for _, r, _ in results])
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    elapsed = time.perf_counter() - start
+
+    if len(cached) > 0:
+        logger.info(f"Reused cached results of {len(cached)} files.")
+    if n_sheets > 0:
+        logger.info(
+            f"Read {n_sheets} sheets from {len(pending)} files in {elapsed:.2f}s "
+            f"with {workers} workers ({n_sheets / elapsed:.1f} sheets/s, "
+            f"{elapsed / n_sheets * 1000:.1f} ms/sheet)."
+        )
+
+
+def watch_directory(
+    paper: str,
+    path: Union[str, os.PathLike],
+    output: Optional[str] = None,
+    workers: Optional[int] = None,
+    interval: float = 1.0,
+    journal: Optional[str] = None,
+    timer: Optional[StageTimer] = None,
+    profile_dir: Optional[str] = None,
+    debug_dir: Optional[str] = None,
+    scoring: str = "global",
+) -> None:
+    workers = workers or os.cpu_count() or 1
+    max_pending = workers * 2
+    journal = journal or os.path.join(path, ".omr_journal")
+
+    # Files are written to the journal before they are submitted, so a sheet
+    # is never graded twice, even across restarts
+    claimed = set()
+    if os.path.exists(journal):
+        with open(journal, encoding="utf-8") as f:
+            claimed = set(f.read().splitlines())
+
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        logger.info("Stopping, waiting for sheets in progress to finish.")
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    sizes = {}
+    pending = {}
+    # Sheets in the journal are not graded again after a restart, so their
+    # results from earlier runs are kept
+    writer = ResultWriter(output, append=True) if output is not None else None
+    logger.info(f'Watching "{path}" with {workers} workers.')
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(paper, timer is not None, profile_dir, debug_dir, scoring),
+    ) as executor, open(journal, "a", encoding="utf-8") as journal_file:
+        while not stop.is_set() or len(pending) > 0:
+            # New scans stay on disk while the pool is full, which bounds memory
+            if not stop.is_set() and len(pending) < max_pending:
+                for filename in list_images(path):
+                    if filename in claimed:
+                        continue
+                    try:
+                        size = os.path.getsize(filename)
+                    except OSError:
+                        continue
+                    # Only pick up files whose size held steady since last poll
+                    if sizes.get(filename) != size:
+                        sizes[filename] = size
+                        continue
+                    if len(pending) >= max_pending:
+                        break
+                    del sizes[filename]
+                    claimed.add(filename)
+                    journal_file.write(filename + "\n")
+                    journal_file.flush()
+                    pending[executor.submit(_read_in_worker, filename)] = filename
+
+            if len(pending) == 0:
+                stop.wait(interval)
+                continue
+
+            done, _ = wait(pending, timeout=interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                filename = pending.pop(future)
+                try:
+                    results = future.result()
+                except Exception as e:
+                    logger.exception(e)
+                    continue
+                for page, scores, timings in results:
+                    if timer is not None and timings is not None:
+                        timer.observe_sheet(timings)
+                    if writer is None:
+                        logger.info(f"{filename}, page {page}: {scores}")
+                    else:
+                        writer.write({"NAMA FAIL": filename, "HALAMAN": page, **scores})
+            if writer is not None:
+                writer.flush()
+
+    if writer is not None:
+        writer.close()
 
 
 def type_path(path: str):
@@ -122,7 +376,64 @@ def parse_args() -> argparse.Namespace:
         help="Types of paper",
     )
     parser.add_argument(
-        "--path", type=str, required=True, help="Path to image or directory of images"
+        "--path",
+        type=str,
+        required=True,
+        help="Path to image, multi-page TIFF or PDF, or directory of them",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes for directory mode (default: CPU count)",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Stream results to a .csv, .jsonl or .parquet file as they are read",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep watching the directory and grade new images as they arrive",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=1.0,
+        help="Seconds between directory polls in watch mode",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        default=None,
+        help="SQLite file of graded sheets, unchanged sheets are not read again",
+    )
+    parser.add_argument(
+        "--timings",
+        type=str,
+        default=None,
+        help="Export per-stage timing histograms to a .json or .prom file",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Directory to write a cProfile dump of every sheet to",
+    )
+    parser.add_argument(
+        "--debug-dir",
+        type=str,
+        default=None,
+        help="Directory to write overlays of rejected, ambiguous or flagged sheets to",
+    )
+    parser.add_argument(
+        "--scoring",
+        choices=list(SCORING),
+        default="global",
+        help="Score bubbles against one sheet-wide threshold, or against the "
+        "paper around each cell and send unclear answers to review",
     )
     args = parser.parse_args()
     return args
@@ -135,21 +446,86 @@ def get_path_type(path: str) -> str:
         return "dir"
 
 
+def write_results(
+    results: Iterator[Tuple[str, int, dict]], output: Optional[str] = None
+) -> None:
+    if output is None:
+        for filename, page, scores in results:
+            logger.info(f"{filename}, page {page}: {scores}")
+        return
+
+    with ResultWriter(output) as writer:
+        for filename, page, scores in results:
+            writer.write({"NAMA FAIL": filename, "HALAMAN": page, **scores})
+
+
 def main() -> None:
     args = parse_args()
+    if args.paper not in LAYOUTS:
+        logger.error(f"No answer sheet layout is defined for {args.paper} yet.")
+        return
 
     path_type = get_path_type(args.path)
 
-    if args.paper == "IMK":
-        reader = IMKReader()
-    elif args.paper == "IKK":
-        reader = IKKReader()
-    else:
-        reader = IKPReader()
+    timer = None
+    if args.timings is not None or args.profile is not None:
+        timer = StageTimer()
 
     if path_type == "file":
-        scores = reader.read_single_file(args.path)
-        logger.info(scores)
+        if args.profile is not None:
+            timer.add_hook(ProfileHook(args.profile))
+        reader = READERS[args.paper](
+            timer=timer, debug_dir=args.debug_dir, scoring=args.scoring
+        )
+        results = (
+            (args.path, page, scores) for page, scores in reader.read_file(args.path)
+        )
+        write_results(results, args.output)
+        if reader.reader.dumper is not None:
+            reader.reader.dumper.close()
+    elif args.watch:
+        watch_directory(
+            args.paper,
+            args.path,
+            output=args.output,
+            workers=args.workers,
+            interval=args.interval,
+            timer=timer,
+            profile_dir=args.profile,
+            debug_dir=args.debug_dir,
+            scoring=args.scoring,
+        )
+    elif args.cache is None:
+        results = read_directory(
+            args.paper,
+            args.path,
+            workers=args.workers,
+            timer=timer,
+            profile_dir=args.profile,
+            debug_dir=args.debug_dir,
+            scoring=args.scoring,
+        )
+        write_results(results, args.output)
+    else:
+        with ResultCache(
+            args.cache, READERS[args.paper](scoring=args.scoring).config()
+        ) as cache:
+            results = read_directory(
+                args.paper,
+                args.path,
+                workers=args.workers,
+                cache=cache,
+                timer=timer,
+                profile_dir=args.profile,
+                debug_dir=args.debug_dir,
+                scoring=args.scoring,
+            )
+            write_results(results, args.output)
+
+    if timer is not None:
+        timer.log_summary()
+        if args.timings is not None:
+            timer.export(args.timings)
 
 
 if __name__ == "__main__":
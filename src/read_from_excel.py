@@ -1,9 +1,13 @@
+import numpy as np
 import pandas as pd
-from typing import Union
+from typing import Iterable, Union
 from pathlib import Path
 import os
 
 from utils.console import logger
+from utils.excel_cache import read_excel
+from utils.excel_utils import normalize_ic
+from utils.result_writer import is_result_file, read_results
 
 
 def validate_path(
@@ -23,45 +27,114 @@ def validate_path(
     return True
 
 
+RIASEK = [
+    "REALISTIK",
+    "INVESTIGATIF",
+    "ARTISTIK",
+    "SOSIAL",
+    "ENTERPRISING",
+    "KONVENSIONAL",
+]
+RANKING = ["1st", "2nd", "3rd"]
+KOD_HOLLANDS = ["KOD HOLLAND 1", "KOD HOLLAND 2", "KOD HOLLAND 3"]
+
+
+def holland_codes(df: pd.DataFrame) -> pd.DataFrame:
+    scores = df[RIASEK].to_numpy()
+
+    # A stable sort keeps tied scores in RIASEK order, like nlargest does
+    order = np.argsort(-scores, axis=1, kind="stable")[:, : len(RANKING)]
+    letters = np.array([category[0] for category in RIASEK])
+
+    df = df.copy()
+    df[RANKING] = np.take_along_axis(scores, order, axis=1)
+    df[KOD_HOLLANDS] = letters[order]
+    df["INDEX PERBEZAAN"] = scores.max(axis=1) - scores.min(axis=1)
+    return df
+
+
 def read_imk(
-    input_path: Union[str, bytes, os.PathLike],
+    input_path: Union[str, bytes, os.PathLike, pd.DataFrame, Iterable[dict]],
     output_path: Union[str, bytes, os.PathLike],
 ):
-    if not validate_path(input_path):
-        return
-    validate_path(output_path, create_on_missing=True)
-
-    RIASEK = [
-        "REALISTIK",
-        "INVESTIGATIF",
-        "ARTISTIK",
-        "SOSIAL",
-        "ENTERPRISING",
-        "KONVENSIONAL",
-    ]
     COLUMNS = ["NAMA", "TINGKATAN", "KELAS", "NO. KAD PENGENALAN"] + RIASEK
-    RANKING = ["1st", "2nd", "3rd"]
-    KOD_HOLLANDS = ["KOD HOLLAND 1", "KOD HOLLAND 2", "KOD HOLLAND 3"]
 
-    df = pd.read_excel(input_path, dtype={"NO. KAD PENGENALAN": str, "TINGKATAN": str})
+    # Results streamed by the grader are identified by their scan file instead,
+    # they can come from a result file or straight from the grader as rows
+    if isinstance(input_path, (str, bytes, os.PathLike)):
+        if not validate_path(input_path):
+            return
+        if is_result_file(input_path):
+            df = read_results(input_path)
+        else:
+            df = read_excel(
+                input_path, dtype={"NO. KAD PENGENALAN": str, "TINGKATAN": str}
+            )
+    elif isinstance(input_path, pd.DataFrame):
+        df = input_path
+    else:
+        df = pd.DataFrame.from_records(input_path)
+    validate_path(output_path, create_on_missing=True)
+
+    if "REKOD" in df.columns:
+        df = df[df["REKOD"] == 1]
+        tags = [c for c in ["NAMA FAIL", "HALAMAN"] if c in df.columns]
+        COLUMNS = tags + [c for c in COLUMNS if c in df.columns]
     df = df[COLUMNS]
     df = df.dropna()
-    f = df["NO. KAD PENGENALAN"].str.contains("[0-9]{12}")
-    df = df[f]
-
-    df[RANKING] = [row.nlargest(3).values for _, row in df[RIASEK].iterrows()]
-    df[KOD_HOLLANDS] = [
-        row.nlargest(3).index.values for _, row in df[RIASEK].iterrows()
-    ]
-    for KH in KOD_HOLLANDS:
-        df[KH] = df[KH].str[0]
-    df["INDEX PERBEZAAN"] = df[RIASEK].max(axis=1) - df[RIASEK].min(axis=1)
+    if "NO. KAD PENGENALAN" in df.columns:
+        f = df["NO. KAD PENGENALAN"].str.contains("[0-9]{12}")
+        df = df[f]
+
+    df = holland_codes(df)
     df = df[COLUMNS + ["INDEX PERBEZAAN"] + RANKING + KOD_HOLLANDS]
 
     with pd.ExcelWriter(output_path) as writer:
         df.to_excel(writer, sheet_name="IMK", index=False)
 
 
+IKP_SHEETS = ["IKP(1)", "IKP(2)"]
+IKP_COLUMNS = ["NAMA", "TINGKATAN", "NO. KAD PENGENALAN"]
+PAPER1_FIELD = [
+    "VERBAL LINGUISTIK (BM)",
+    "VERBAL LINGUISTIK (BI)",
+    "LOGIK MATEMATIK",
+    "VISUAL RUANG 1",
+]
+PAPER2_FIELD = [
+    "(+) VISUAL RUANG2",
+    "MUZIK",
+    "NATURALIS",
+    "INTRAPESONAL",
+    "INTERPESONAL",
+    "KINESTATIK",
+    "EKSISTENTIAL",
+]
+COMBINED_FIELD = PAPER1_FIELD[:-1] + ["VISUAL RUANG"] + PAPER2_FIELD[1:]
+
+
+def is_ikp_column(column: str) -> bool:
+    # Only these columns of either paper are loaded from the workbook
+    return column in IKP_COLUMNS or column in PAPER1_FIELD or column in PAPER2_FIELD
+
+
+def ikp_paper(df: pd.DataFrame, fields: list, paper: int) -> pd.DataFrame:
+    df = df[IKP_COLUMNS + fields]
+    df = df.assign(**{"NO. KAD PENGENALAN": normalize_ic(df["NO. KAD PENGENALAN"])})
+    df = df.dropna()
+    logger.info(f"Number of student answered paper {paper}: {len(df)}")
+
+    dup = df.duplicated(subset=["NO. KAD PENGENALAN"], keep=False)
+    if dup.any():
+        logger.warning(f"{dup.sum()} duplicates found in paper {paper}")
+        logger.info(df.loc[dup, IKP_COLUMNS].sort_values("NO. KAD PENGENALAN"))
+        df = df.drop_duplicates(subset=["NO. KAD PENGENALAN"])
+        logger.info(
+            f"Number of student answered paper {paper} after removing duplicates: {len(df)}"
+        )
+    return df
+
+
 def read_ikp(
     input_path: Union[str, bytes, os.PathLike],
     output_path: Union[str, bytes, os.PathLike],
@@ -70,68 +143,28 @@ def read_ikp(
         return
     validate_path(output_path, create_on_missing=True)
 
-    COLUMNS = ["NAMA", "TINGKATAN", "NO. KAD PENGENALAN"]
-    PAPER1_FIELD = [
-        "VERBAL LINGUISTIK (BM)",
-        "VERBAL LINGUISTIK (BI)",
-        "LOGIK MATEMATIK",
-        "VISUAL RUANG 1",
-    ]
-    PAPER2_FIELD = [
-        "(+) VISUAL RUANG2",
-        "MUZIK",
-        "NATURALIS",
-        "INTRAPESONAL",
-        "INTERPESONAL",
-        "KINESTATIK",
-        "EKSISTENTIAL",
-    ]
-    COMBINED_FIELD = PAPER1_FIELD[:-1] + ["VISUAL RUANG"] + PAPER2_FIELD[1:]
-
-    def fn(s):
-        s = str(s)
-        if not s.startswith("0"):
-            return "0" + s
-
-    paper1: pd.DataFrame = pd.read_excel(
-        input_path, sheet_name="IKP(1)", converters={"NO. KAD PENGENALAN": fn}
+    # Both papers come from one pass over the workbook, with only the columns
+    # that are used, and ICs are read as text and normalized in bulk
+    sheets = read_excel(
+        input_path,
+        sheet_name=IKP_SHEETS,
+        usecols=is_ikp_column,
+        dtype={"NO. KAD PENGENALAN": str},
     )
-    paper2: pd.DataFrame = pd.read_excel(
-        input_path, sheet_name="IKP(2)", converters={"NO. KAD PENGENALAN": fn}
+    paper1 = ikp_paper(sheets["IKP(1)"], PAPER1_FIELD, 1)
+    paper2 = ikp_paper(sheets["IKP(2)"], PAPER2_FIELD, 2)
+
+    # Names and forms are taken from paper 1
+    df = paper1.merge(
+        paper2.drop(columns=["NAMA", "TINGKATAN"]),
+        on=["NO. KAD PENGENALAN"],
+        validate="1:1",
     )
-    paper1 = paper1[COLUMNS + PAPER1_FIELD]
-    paper2 = paper2[COLUMNS + PAPER2_FIELD]
-
-    paper1.dropna(inplace=True)
-    paper2.dropna(inplace=True)
-    logger.info(f"Number of student answered paper 1: {len(paper1)}")
-    logger.info(f"Number of student answered paper 2: {len(paper2)}")
-
-    dup1 = paper1[paper1.duplicated(subset=["NO. KAD PENGENALAN"], keep=False)]
-    dup2 = paper2[paper2.duplicated(subset=["NO. KAD PENGENALAN"], keep=False)]
-    if not dup1.empty:
-        logger.warning(f"{len(dup1)} duplicates found in paper 1")
-        logger.info(dup1[COLUMNS].sort_values("NO. KAD PENGENALAN"))
-        paper1.drop_duplicates(subset=["NO. KAD PENGENALAN"], inplace=True)
-        logger.info(
-            f"Number of student answered paper 1 after removing duplicates: {len(paper1)}"
-        )
-    if not dup2.empty:
-        logger.warning(f"{len(dup2)} duplicates found in paper 2")
-        logger.info(dup2[COLUMNS].sort_values("NO. KAD PENGENALAN"))
-        paper2.drop_duplicates(subset=["NO. KAD PENGENALAN"], inplace=True)
-        logger.info(
-            f"Number of student answered paper 2 after removing duplicates: {len(paper2)}"
-        )
-
-    df = paper1.merge(paper2, on=["NO. KAD PENGENALAN"], validate="1:1")
-    df.drop(["NAMA_y", "TINGKATAN_y"], axis=1, inplace=True)
-    df.rename(columns={"NAMA_x": "NAMA", "TINGKATAN_x": "TINGKATAN"}, inplace=True)
     logger.info(f"Number of student answered paper 1 and 2: {len(df)}")
 
     df["VISUAL RUANG"] = df["VISUAL RUANG 1"] + df["(+) VISUAL RUANG2"]
-    df.drop(["VISUAL RUANG 1", "(+) VISUAL RUANG2"], axis=1, inplace=True)
-    df[COMBINED_FIELD] = df[COMBINED_FIELD].apply(lambda x: x * 100).astype("uint8")
+    df = df.drop(columns=["VISUAL RUANG 1", "(+) VISUAL RUANG2"])
+    df[COMBINED_FIELD] = (df[COMBINED_FIELD] * 100).round().astype("uint8")
 
     df.to_excel(output_path, index=False)
 
@@ -1,76 +1,335 @@
+import io
 import os
-from typing import Union
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from itertools import islice
+from typing import Iterable, Iterator, Optional, Tuple, Union
 
 import cv2
 import numpy as np
 
 from utils import reader_utils
 from utils.console import logger
+from utils.debug_dump import DebugDumper, copy_artifacts
+from utils.pages import Page, load_page
+from utils.profiling import StageTimer
+
+# "global" thresholds the whole sheet at once and counts dark pixels per cell,
+# "adaptive" measures every cell against the paper around it
+SCORING = ("global", "adaptive")
+
+# Anything read_many accepts: a path, a page of a multi-page scan, encoded
+# image bytes or a decoded image
+ImageSource = Union[str, os.PathLike, Page, bytes, bytearray, memoryview, np.ndarray]
 
 
 class Reader:
-    def __init__(self, n_rows: int, n_cols: int, debug: bool = False):
+    def __init__(
+        self,
+        n_rows: int,
+        n_cols: int,
+        debug: bool = False,
+        *,
+        min_pixel: int = 300,
+        precheck: bool = True,
+        pyramid_level: int = 1,
+        scoring: str = "global",
+        fill_cutoff: float = 0.3,
+        review_confidence: float = 0.9,
+        timer: Optional[StageTimer] = None,
+        debug_dir: Optional[Union[str, os.PathLike]] = None,
+    ):
         self.n_rows = n_rows
         self.n_cols = n_cols
+        self.min_pixel = min_pixel
+        self.precheck = precheck
+        self.pyramid_level = pyramid_level
+        if scoring not in SCORING:
+            raise ValueError(
+                f'Unknown scoring "{scoring}", use one of {", ".join(SCORING)}.'
+            )
+        self.scoring = scoring
+        self.fill_cutoff = fill_cutoff
+        self.review_confidence = review_confidence
+        # Per bubble fill confidence of the last sheet, with adaptive scoring
+        self.confidence: Optional[np.ndarray] = None
+        self.uncertain: Optional[np.ndarray] = None
+        self.timer = timer
         self.debug = debug
+        # Overlays of flagged sheets are written in the background, headless
+        self.dumper = DebugDumper(debug_dir) if debug_dir is not None else None
+        self._debug_state = None
 
         self.new_size = (210 * 5, 297 * 5)
+        # The question box is searched on a downscaled pyramid level only
+        self.detect_size = (
+            self.new_size[0] >> pyramid_level,
+            self.new_size[1] >> pyramid_level,
+        )
+        self.min_area = 500 / 4**pyramid_level
         warpH, warpW = 297 * 3, 210 * 3
         warpH = warpH - (warpH % n_rows)
         warpW = warpW - (warpW % n_cols)
         self.warp_size = (warpW, warpH)
+        self.warp_points = np.float32([[0, 0], [warpW, 0], [0, warpH], [warpW, warpH]])
+
+        # Work buffers reused across calls, so a Reader is not thread-safe
+        self._buffers = {}
+        for name, size in [
+            ("resized", self.detect_size),
+            ("blur", self.detect_size),
+            ("canny", self.detect_size),
+            ("warped", self.warp_size),
+            ("thresh", self.warp_size),
+        ]:
+            self._buffer(name, (size[1], size[0]))
 
     def read(self, filename: Union[str, bytes, os.PathLike]) -> Union[np.ndarray, str]:
+        if self.timer is None:
+            return self._read(filename)
+        with self.timer.sheet(filename):
+            return self._read(filename)
+
+    def _stage(self, name: str):
+        return nullcontext() if self.timer is None else self.timer.stage(name)
+
+    def read_many(
+        self, sources: Iterable[ImageSource], prefetch: int = 4, threads: int = 2
+    ) -> Iterator[Union[np.ndarray, str]]:
+        # Upcoming images are decoded on a thread pool while the current one is
+        # processed, at most prefetch of them are held in memory at a time
+        sources = enumerate(sources)
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="imread")
+
+        def submit(n: int) -> None:
+            for index, source in islice(sources, n):
+                pending.append((index, source, executor.submit(self._load, source)))
+
+        try:
+            submit(prefetch)
+            while len(pending) > 0:
+                index, source, future = pending.popleft()
+                submit(1)
+                yield self._read_loaded(index, source, future)
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def _read_loaded(
+        self, index: int, source: ImageSource, future: Future
+    ) -> Union[np.ndarray, str]:
+        name = self.source_name(index, source)
+        try:
+            imgOrig, seconds = future.result()
+        except FileNotFoundError:
+            logger.critical(f'File "{name}" does not exists.')
+            return f'File "{name}" does not exists.'
+
+        if self.timer is None:
+            return self._read_image(name, imgOrig)
+        with self.timer.sheet(name, offloaded=seconds):
+            self.timer.record("imread", seconds)
+            return self._read_image(name, imgOrig)
+
+    def _load(self, source: ImageSource) -> Tuple[Optional[np.ndarray], float]:
+        start = time.perf_counter()
+        if isinstance(source, Page):
+            if not self.file_exists(source.filename):
+                raise FileNotFoundError(source.filename)
+        elif not isinstance(source, (np.ndarray, bytes, bytearray, memoryview)):
+            if not self.file_exists(source):
+                raise FileNotFoundError(source)
+        imgOrig = self._decode(source)
+        return imgOrig, time.perf_counter() - start
+
+    def _decode(self, source: ImageSource) -> Optional[np.ndarray]:
+        if isinstance(source, Page):
+            if not source.multi_page:
+                return self._decode(source.filename)
+            try:
+                source = load_page(source)
+            except (cv2.error, ImportError, RuntimeError, ValueError, IndexError) as e:
+                logger.error(e)
+                return None
+            if source is None:
+                return None
+
+        if isinstance(source, np.ndarray):
+            if source.size == 0:
+                return None
+            return reader_utils.toGray(reader_utils.to8Bit(source))
+
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            buffer = np.frombuffer(source, dtype=np.uint8)
+            if buffer.size == 0:
+                return None
+            header = io.BytesIO(buffer)
+
+            def decode(flags: int) -> Optional[np.ndarray]:
+                return cv2.imdecode(buffer, flags)
+
+        else:
+            header = os.fspath(source)
+
+            def decode(flags: int) -> Optional[np.ndarray]:
+                return cv2.imread(os.fspath(source), flags)
+
+        # Decode straight to gray, shrunk while decoding when the scan is large.
+        # The factor comes from this image's own size, read from its header or
+        # else from the smallest decode, so a sheet reads the same whatever was
+        # read before it
+        flags = cv2.IMREAD_IGNORE_ORIENTATION
+        img = None
+        shape = reader_utils.imageShape(header)
+        if shape is None:
+            img = decode(reader_utils.REDUCED_GRAYSCALE[8] | flags)
+            if img is None:
+                return None
+            shape = (img.shape[0] * 8, img.shape[1] * 8)
+        factor = reader_utils.reduceFactor(shape, self.new_size)
+        if img is None or factor != 8:
+            img = decode(reader_utils.REDUCED_GRAYSCALE[factor] | flags)
+        while (
+            img is not None
+            and factor > 1
+            and (img.shape[1] < self.new_size[0] or img.shape[0] < self.new_size[1])
+        ):
+            factor //= 2
+            img = decode(reader_utils.REDUCED_GRAYSCALE[factor] | flags)
+        return img
+
+    def _read(self, filename: Union[str, bytes, os.PathLike]) -> Union[np.ndarray, str]:
         if not self.file_exists(filename):
             logger.critical(f'File "{filename}" does not exists.')
             return f'File "{filename}" does not exists.'
 
         # Read image then preprocess
-        imgOrig = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
-        imgOrig = cv2.resize(imgOrig, self.new_size)
-        imgGray = cv2.cvtColor(imgOrig, cv2.COLOR_BGR2GRAY)
-        imgBlur = cv2.GaussianBlur(imgGray, (5, 5), 1)
-        imgCanny = cv2.Canny(imgBlur, 10, 50)
+        with self._stage("imread"):
+            imgOrig = self._decode(filename)
+        return self._read_image(filename, imgOrig)
+
+    def _read_image(
+        self, filename: Union[str, bytes, os.PathLike], imgOrig: Optional[np.ndarray]
+    ) -> Union[np.ndarray, str]:
+        self._debug_state = None
+        self.confidence = None
+        self.uncertain = None
+        if imgOrig is None or imgOrig.size == 0:
+            logger.error(f'Unable to read image "{filename}".')
+            return "Unable to read image."
+
+        with self._stage("resize"):
+            imgSmall = reader_utils.shrinkImage(
+                imgOrig, self.detect_size, dst=self._buffers["resized"]
+            )
+
+        # Reject blank, cropped or unreadable scans on a thumbnail first
+        if self.precheck:
+            with self._stage("precheck"):
+                check = reader_utils.precheckScan(imgSmall)
+            if not check.ok:
+                logger.error(
+                    f'Rejected image "{filename}": {check.reason} '
+                    f"(confidence {check.confidence:.2f})."
+                )
+                self._debug_state = dict(imgSmall=imgSmall)
+                self.dump_debug(filename, "rejected")
+                return f"Scan rejected: {check.reason}."
+
+        with self._stage("blur"):
+            imgBlur = cv2.GaussianBlur(imgSmall, (5, 5), 1, dst=self._buffers["blur"])
+        with self._stage("canny"):
+            imgCanny = cv2.Canny(imgBlur, 10, 50, edges=self._buffers["canny"])
 
         # Find contours, the biggest one is the question's box
-        contours, _ = cv2.findContours(
-            imgCanny, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE
-        )
-        rectCon = reader_utils.rectContour(contours, min_area=500)
+        with self._stage("contours"):
+            contours, _ = cv2.findContours(
+                imgCanny, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
+            )
+            rectCon = reader_utils.rectContour(contours, min_area=self.min_area)
+        if len(rectCon) == 0:
+            logger.error(f'Error finding question box for image "{filename}".')
+            self._debug_state = dict(imgSmall=imgSmall)
+            self.dump_debug(filename, "no-box")
+            return f"Error finding question box."
         questionBox = reader_utils.getCornerPoints(rectCon[0])
 
         if questionBox.size == 0:
             logger.error(f'Error finding question box for image "{filename}".')
             return f"Error finding question box."
 
-        # Warp the box in case it is not straight
-        box = reader_utils.reorder(questionBox)
-        pts1 = np.float32(box)
-        pts2 = np.float32(
-            [[0, 0], [self.warp_size[0], 0], [0, self.warp_size[1]], [*self.warp_size]]
-        )
-        matrix = cv2.getPerspectiveTransform(pts1, pts2)
-        imgWarped = cv2.warpPerspective(imgGray, matrix, self.warp_size)
+        # Scale the corners back up and warp from the full resolution image
+        with self._stage("warp"):
+            box = reader_utils.reorder(questionBox)
+            scale = (
+                imgOrig.shape[1] / self.detect_size[0],
+                imgOrig.shape[0] / self.detect_size[1],
+            )
+            pts1 = reader_utils.refineCorners(imgOrig, box, scale)
+            matrix = cv2.getPerspectiveTransform(pts1, self.warp_points)
+            imgWarped = cv2.warpPerspective(
+                imgOrig, matrix, self.warp_size, dst=self._buffers["warped"]
+            )
 
-        # Apply thresholding to the image
-        mean = np.mean(imgWarped) - 10
-        imgThresh = cv2.threshold(imgWarped, mean, 255, cv2.THRESH_BINARY_INV)[1]
+        if self.scoring == "adaptive":
+            with self._stage("scoring"):
+                scores, fill, self.confidence = reader_utils.scoreCells(
+                    imgWarped, self.n_rows, self.n_cols, cutoff=self.fill_cutoff
+                )
+            # Bubbles that are neither clearly blank nor clearly filled go to review
+            self.uncertain = (
+                np.abs(self.confidence - 0.5) < self.review_confidence - 0.5
+            )
+            uncertain = self.uncertain
 
-        boxes = reader_utils.splitBoxes(imgThresh, self.n_rows, self.n_cols)
-        scores = np.zeros((self.n_rows, self.n_cols), dtype=int)
-        pixVal = np.zeros((self.n_rows, self.n_cols), dtype=int)
+            # Debug overlays show the fill in pixels, like the global scoring
+            cellArea = (self.warp_size[0] // self.n_cols) * (
+                self.warp_size[1] // self.n_rows
+            )
+            imgThresh = cv2.bitwise_not(imgWarped, dst=self._buffers["thresh"])
+            pixVal = np.round(fill * cellArea).astype(int)
+            minPixel = round(self.fill_cutoff * cellArea)
+        else:
+            # Apply thresholding to the image
+            with self._stage("threshold"):
+                mean = cv2.mean(imgWarped)[0] - 10
+                imgThresh = cv2.threshold(
+                    imgWarped,
+                    mean,
+                    255,
+                    cv2.THRESH_BINARY_INV,
+                    dst=self._buffers["thresh"],
+                )[1]
 
-        for i, row in enumerate(boxes):
-            for j, col in enumerate(row):
-                blackened = cv2.countNonZero(col)
-                scores[i, j] = 1 if blackened >= 300 else 0
-                pixVal[i, j] = blackened
+            with self._stage("scoring"):
+                scores, pixVal = reader_utils.scoreGrid(
+                    imgThresh, self.n_rows, self.n_cols, self.min_pixel
+                )
+            # Cells close to the cutoff are the ones worth looking at
+            uncertain = np.abs(pixVal - self.min_pixel) < self.min_pixel / 8
+            minPixel = self.min_pixel
+
+        if self.dumper is not None:
+            self._debug_state = dict(
+                imgSmall=imgSmall,
+                rectCon=rectCon,
+                imgWarped=imgWarped,
+                imgThresh=imgThresh,
+                pixVal=pixVal,
+                min_pixel=minPixel,
+            )
+            if np.any(uncertain):
+                self.dump_debug(filename, "ambiguous")
 
         if self.debug:
-            imgCont = imgOrig.copy()
+            imgCont = reader_utils.toBGR(imgSmall)
             cv2.drawContours(imgCont, rectCon, -1, (0, 255, 0), 3)
             reader_utils.showImages(
-                [imgOrig, imgBlur, imgCanny, imgCont],
+                [imgSmall, imgBlur, imgCanny, imgCont],
                 titles=["Original", "Blur", "Canny", "Contour"],
                 nrow=1,
             )
@@ -80,6 +339,43 @@ class Reader:
 
         return scores
 
+    def dump_debug(self, filename: Union[str, bytes, os.PathLike], reason: str) -> None:
+        # At most one overlay per sheet, for the first reason it was flagged
+        if self.dumper is None or self._debug_state is None:
+            return
+        name = (
+            f"{os.path.splitext(os.path.basename(os.fsdecode(filename)))[0]}_{reason}"
+        )
+        self.dumper.submit(name, copy_artifacts(**self._debug_state, reason=reason))
+        self._debug_state = None
+
+    def config(self) -> dict:
+        return {
+            "n_rows": self.n_rows,
+            "n_cols": self.n_cols,
+            "min_pixel": self.min_pixel,
+            "precheck": self.precheck,
+            "pyramid_level": self.pyramid_level,
+            "scoring": self.scoring,
+            "fill_cutoff": self.fill_cutoff,
+        }
+
+    def _buffer(self, name: str, shape: tuple, dtype=np.uint8) -> np.ndarray:
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buffer
+        return buffer
+
+    @staticmethod
+    def source_name(index: int, source: ImageSource) -> Union[str, os.PathLike]:
+        # In-memory images are named by their position in the batch
+        if isinstance(source, Page):
+            return source.name
+        if isinstance(source, (str, os.PathLike)):
+            return source
+        return f"image_{index:05d}"
+
     @staticmethod
     def file_exists(filename: Union[str, bytes, os.PathLike]) -> bool:
         return os.path.exists(filename)
@@ -1,58 +1,281 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+from typing import Optional
+
 import pandas as pd
+import requests
+from rich.progress import track
+
+from build_database import DATABASE_PATH, sid_pattrn
+from read_from_excel import RIASEK
+from utils import (
+    BASE_URL,
+    RateLimiter,
+    create_session,
+    load_reference,
+    normalize_ic,
+    normalize_name,
+    pool_session,
+    read_excel,
+    validate_name,
+)
+from utils.console import logger
+from utils.upload_journal import UploadJournal, payload_digest
+
+IMK_URL = "/murid/k_imk_murid.php"
+JOURNAL_PATH = "../data/database/upload_journal.sqlite"
+
+imk_pattrn = r"idimk=(\d+)"
+
+
+def match_students(
+    df: pd.DataFrame,
+    links: pd.DataFrame,
+    confirmed: Optional[pd.Series] = None,
+    name_only: bool = False,
+) -> pd.DataFrame:
+    # Graded students are found in the student database by name, names shared
+    # by more than one student there cannot be told apart and are left out.
+    # Only students whose IC was confirmed in APDM are matched by an official
+    # name, others are left out unless name-only matches are allowed
+    links = links.assign(
+        KEY=normalize_name(links["NAMA"]),
+        txtIDMurid=links["link"].str.extract(sid_pattrn, expand=False),
+        txtIDimk=links["link"].str.extract(imk_pattrn, expand=False),
+    )
+    links = links.dropna(subset=["KEY", "txtIDMurid", "txtIDimk"])
+    shared = links["KEY"].duplicated(keep=False)
+    if shared.any():
+        logger.warning(f"{shared.sum()} students share a name in the database.")
+    links = links[~shared].set_index("KEY")[["txtIDMurid", "txtIDimk"]]
+
+    df = (
+        df.assign(KEY=normalize_name(df["NAMA"]))
+        .join(links, on="KEY", how="left")
+        .drop(columns="KEY")
+    )
+    missing = df["txtIDMurid"].isna()
+    if missing.any():
+        logger.warning(f"{missing.sum()} students are not in the database.")
+        logger.info(df.loc[missing, ["NAMA", "NO. KAD PENGENALAN"]])
+    df = df[~missing]
+
+    if confirmed is None:
+        unconfirmed = pd.Series(True, index=df.index)
+    else:
+        unconfirmed = ~confirmed.reindex(df.index, fill_value=False)
+    if unconfirmed.any():
+        logger.warning(
+            f"{unconfirmed.sum()} students are matched by name only, "
+            "their IC is not in APDM."
+        )
+        logger.info(df.loc[unconfirmed, ["NAMA", "NO. KAD PENGENALAN"]])
+        if not name_only:
+            logger.warning(
+                "Students matched by name only are not uploaded, "
+                "pass --allow-name-only to upload them."
+            )
+            df = df[~unconfirmed]
+    return df
+
+
+def build_payloads(df: pd.DataFrame, test_date: str) -> pd.DataFrame:
+    # One form per student, the categories are always sent in RIASEK order
+    payloads = pd.DataFrame(
+        {
+            "txtIDMurid": df["txtIDMurid"],
+            "txtIDimk": df["txtIDimk"],
+            "txtTimk": test_date,
+        },
+        index=df.index,
+    )
+    for i, category in enumerate(RIASEK, start=1):
+        payloads[f"txtHol{i}"] = category[0]
+        payloads[f"txtMark{i}"] = df[category].astype(int)
+    payloads["btnKemasIMK"] = "Kemaskini+Rekod"
+    return payloads
+
 
-from utils import create_session, fix_ic
+def post_payload(
+    session: requests.Session,
+    base_url: str,
+    payload: dict,
+    limiter: RateLimiter,
+    timeout: float = 30.0,
+) -> None:
+    limiter.wait()
+    resp = session.post(
+        f"{base_url}{IMK_URL}",
+        params={"idmurid": payload["txtIDMurid"], "idimk": payload["txtIDimk"]},
+        data=payload,
+        timeout=timeout,
+    )
+    resp.raise_for_status()
 
 
-def upload(df: pd.DataFrame):
-    pass
+def upload(
+    df: pd.DataFrame,
+    session: requests.Session,
+    journal: UploadJournal,
+    base_url: str = BASE_URL,
+    test_date: Optional[str] = None,
+    workers: int = 4,
+    rate: float = 5.0,
+) -> int:
+    test_date = test_date or date.today().strftime("%d-%m-%Y")
+    payloads = build_payloads(df, test_date).to_dict("records")
+
+    # Records are keyed by student and inventory, marks the server already has
+    # are not sent again, whatever date they were sent with
+    done = journal.uploaded()
+    pending = []
+    for payload in payloads:
+        record = f"{payload['txtIDMurid']}:{payload['txtIDimk']}"
+        digest = payload_digest({k: v for k, v in payload.items() if k != "txtTimk"})
+        if (record, digest) not in done:
+            pending.append((record, digest, payload))
+    logger.info(
+        f"Uploading {len(pending)} records, {len(payloads) - len(pending)} "
+        "already uploaded."
+    )
+
+    limiter = RateLimiter(rate)
+    uploaded = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(post_payload, session, base_url, payload, limiter): (
+                record,
+                digest,
+            )
+            for record, digest, payload in pending
+        }
+        for future in track(
+            as_completed(futures), total=len(futures), description="Uploading..."
+        ):
+            record, digest = futures[future]
+            try:
+                future.result()
+            except requests.RequestException as e:
+                logger.error(f"Unable to upload {record}: {e}")
+                continue
+            journal.put(record, digest)
+            uploaded += 1
+
+    if uploaded < len(pending):
+        logger.error(
+            f"{len(pending) - uploaded} records were not uploaded, run again to retry."
+        )
+    return uploaded
 
 
 def main():
-    session = create_session()
-    lnk_df = pd.read_csv("../data/database/student_links.csv", index_col="ID")
-    inp_df: pd.DataFrame = pd.read_excel(
-        "../input/excel/IMK 2021 RESPON.xlsx", converters={"NO. KAD PENGENALAN": fix_ic}
+    parser = argparse.ArgumentParser(description="Upload IMK results to SEPKM")
+    parser.add_argument(
+        "--input",
+        type=str,
+        default="../input/excel/IMK 2021 RESPON.xlsx",
+        help="Workbook of IMK results with the RIASEK score of every student",
+    )
+    parser.add_argument(
+        "--links",
+        type=str,
+        default=DATABASE_PATH,
+        help="CSV file of student links built by build_database.py",
+    )
+    parser.add_argument(
+        "--journal",
+        type=str,
+        default=JOURNAL_PATH,
+        help="SQLite file of uploaded records, which are skipped on a re-run",
+    )
+    parser.add_argument(
+        "--base-url",
+        type=str,
+        default=BASE_URL,
+        help="SEPKM server to upload to, a local stand-in can be used for testing",
+    )
+    parser.add_argument(
+        "--date",
+        type=str,
+        default=None,
+        help="Date the inventory was taken, as DD-MM-YYYY (default: today)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of records posted at the same time",
     )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=5.0,
+        help="Most records posted per second, 0 for no limit",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="Number of retries of a failed request, with exponential backoff",
+    )
+    parser.add_argument(
+        "--allow-name-only",
+        action="store_true",
+        help="Also upload students whose IC is not in APDM, matched by name only",
+    )
+    args = parser.parse_args()
+
+    inp_df: pd.DataFrame = read_excel(args.input, dtype={"NO. KAD PENGENALAN": str})
+    inp_df["NO. KAD PENGENALAN"] = normalize_ic(inp_df["NO. KAD PENGENALAN"])
     inp_df.dropna(
         axis=0,
         how="any",
-        subset=["NAMA", "TINGKATAN", "NO. KAD PENGENALAN"],
+        subset=["NAMA", "TINGKATAN", "NO. KAD PENGENALAN"] + RIASEK,
         inplace=True,
     )
-    ESSENTIAL_COL = ["NAMA", "NO. KAD PENGENALAN"]
-    IMK_COL = [
-        "REALISTIK",
-        "INVESTIGATIF",
-        "ARTISTIK",
-        "SOSIAL",
-        "ENTERPRISING",
-        "KONVENSIONAL",
-    ]
-    inp_df = inp_df[ESSENTIAL_COL + IMK_COL]
-    student: pd.Series = inp_df.iloc[0]
-    data = {
-        "txtIDMurid": 7614477,
-        "txtIDimk": 3424739,
-        "txtTimk": "01-03-2019",
-        "txtHol1": "R",
-        "txtMark1": 18,
-        "txtHol2": "I",
-        "txtMark2": 27,
-        "txtHol3": "A",
-        "txtMark3": 23,
-        "txtHol4": "S",
-        "txtMark4": 21,
-        "txtHol5": "E",
-        "txtMark5": 20,
-        "txtHol6": "K",
-        "txtMark6": 26,
-        "btnKemasIMK": "Kemaskini+Rekod",
-    }
-    session.post(
-        "https://epkm.moe.gov.my//murid/k_imk_murid.php?idmurid=7614477&idimk=3424739",
-        data=data,
+    # Names are taken from APDM by IC, students whose IC is found there are
+    # matched on their official name
+    confirmed = None
+    try:
+        reference = load_reference()
+    except FileNotFoundError as e:
+        logger.warning(f"Names are not checked against APDM: {e}")
+    else:
+        inp_df = validate_name(inp_df, reference)
+        confirmed = reference.validate(inp_df["NO. KAD PENGENALAN"])["ADA KP"]
+    links = pd.read_csv(args.links, dtype=str)
+    if "NAMA" not in links.columns:
+        logger.error(f"{args.links} has no student names, run build_database.py.")
+        return
+    inp_df = match_students(
+        inp_df, links, confirmed=confirmed, name_only=args.allow_name_only
     )
 
+    session = create_session(args.base_url)
+    if session is None:
+        logger.error("Unable to log in to SEPKM.")
+        return
+    # Posting the same form again only updates the record, so it can be retried
+    pool_session(
+        session,
+        pool_size=args.workers,
+        retries=args.retries,
+        methods=frozenset({"POST"}),
+    )
+
+    with UploadJournal(args.journal) as journal:
+        uploaded = upload(
+            inp_df,
+            session,
+            journal,
+            base_url=args.base_url,
+            test_date=args.date,
+            workers=args.workers,
+            rate=args.rate,
+        )
+    logger.info(f"Uploaded {uploaded} records.")
+
 
 if __name__ == "__main__":
     main()
@@ -1,5 +1,14 @@
 import urllib3
-from .web_utils import create_session
-from .excel_utils import fix_ic, forms2int, validate_name
+from .web_utils import BASE_URL, RateLimiter, create_session, pool_session
+from .excel_cache import read_excel
+from .excel_utils import (
+    ReferenceIndex,
+    fix_ic,
+    forms2int,
+    load_reference,
+    normalize_ic,
+    normalize_name,
+    validate_name,
+)
 
 urllib3.disable_warnings()
@@ -0,0 +1,127 @@
+import functools
+import hashlib
+import io
+
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+
+from .excel_cache import read_excel
+from .excel_utils import forms2int, normalize_ic, normalize_name, validate_name
+
+INV_MAPPINGS = {
+    "IMK": ["1", "3"],
+    "IKP": ["3"],
+    "ITP 1": ["1"],
+    "ITP 4": ["4"],
+}
+
+
+def pie_label(pct, allvals):
+    absolute = int(round(pct / 100.0 * np.sum(allvals)))
+    return absolute
+
+
+# Streamlit runs the entry script afresh on every rerun, caches that must last
+# across reruns live in an imported module like this one
+@functools.lru_cache(maxsize=256)
+def pie_chart(title: str, present: int, absent: int) -> bytes:
+    # Charts are drawn once for every set of counts and kept as PNG, so a rerun
+    # with the same counts does not touch matplotlib at all. A bare Figure
+    # keeps pyplot's global state out of the script threads
+    fig = Figure()
+    ax = fig.subplots()
+    ax.set_title(title)
+    ax.axis("equal")
+    ax.pie(
+        [present, absent],
+        labels=["Dah Jawap", "Belum Jawap"],
+        autopct=lambda pct: pie_label(pct, [present, absent]),
+        startangle=90,
+        colors=["#4daf4a", "#e41a1c"],
+    )
+    png = io.BytesIO()
+    fig.savefig(png, format="png")
+    return png.getvalue()
+
+
+class Upload:
+    # An uploaded workbook, hashed and compared by its content so cached frames
+    # are reused across reruns until a different file is uploaded
+    def __init__(self, upload):
+        self.data = upload.getvalue()
+        self.digest = hashlib.blake2b(self.data, digest_size=20).hexdigest()
+
+    def __hash__(self) -> int:
+        return hash(self.digest)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Upload) and self.digest == other.digest
+
+    def open(self) -> io.BytesIO:
+        return io.BytesIO(self.data)
+
+
+def student_keys(ics: pd.Series, names: pd.Series) -> np.ndarray:
+    # A student can be matched by IC or by name, both go into one key column
+    ics = "KP " + normalize_ic(ics).fillna("")
+    names = "NAMA " + normalize_name(names).fillna("")
+    return np.concatenate([ics.to_numpy(), names.to_numpy()])
+
+
+# Uploads are only cached in memory, keyed by their digest, they hold ICs and
+# phone numbers that must not be left on disk. Cached frames are shared
+# between reruns and must not be modified in place
+@functools.lru_cache(maxsize=4)
+def load_main_df(df_main: Upload, inv_type: str) -> pd.DataFrame:
+    df_main = read_excel(
+        df_main.open(),
+        cache_dir=None,
+        dtype={"No. KP": str},
+        converters={
+            "Keterangan Tingkatan Tahun": forms2int,
+            "No. Tel Bimbit Penjaga 1": str,
+            "No. Tel Bimbit Penjaga 2": str,
+        },
+    )
+    df_main = df_main.assign(**{"No. KP": normalize_ic(df_main["No. KP"])})
+    df_main = df_main[
+        df_main["Keterangan Tingkatan Tahun"].isin(INV_MAPPINGS[inv_type])
+    ]
+    return df_main
+
+
+@functools.lru_cache(maxsize=4)
+def load_attendance_df(df_attendance: Upload) -> pd.DataFrame:
+    df_attendance: pd.DataFrame = read_excel(
+        df_attendance.open(),
+        cache_dir=None,
+        dtype={"NO. KAD PENGENALAN": str},
+    )
+    df_attendance["NO. KAD PENGENALAN"] = normalize_ic(
+        df_attendance["NO. KAD PENGENALAN"]
+    )
+    df_attendance.dropna(
+        axis=0,
+        how="any",
+        subset=["NAMA", "TINGKATAN", "NO. KAD PENGENALAN"],
+        inplace=True,
+    )
+    df_attendance = validate_name(df_attendance)
+    return df_attendance
+
+
+@functools.lru_cache(maxsize=4)
+def match_attendance(
+    df_main: Upload, df_attendance: Upload, inv_type: str
+) -> pd.DataFrame:
+    main_df = load_main_df(df_main, inv_type)
+    attendance_df = load_attendance_df(df_attendance)
+
+    # Every APDM key is probed once against a hash table of answered keys, a
+    # student has answered when either the IC or the name is found
+    answered = pd.Index(
+        student_keys(attendance_df["NO. KAD PENGENALAN"], attendance_df["NAMA"])
+    ).unique()
+    found = answered.get_indexer(student_keys(main_df["No. KP"], main_df["Nama"]))
+    return main_df.assign(JAWAP=(found >= 0).reshape(2, -1).any(axis=0))
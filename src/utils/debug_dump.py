@@ -0,0 +1,77 @@
+import os
+import queue
+import threading
+from pathlib import Path
+from typing import Optional, Union
+
+import cv2
+import numpy as np
+
+from . import reader_utils
+from .console import logger
+
+
+class DebugDumper:
+    def __init__(
+        self,
+        output_dir: Union[str, os.PathLike],
+        max_queue: int = 32,
+        quality: int = 85,
+        idle_timeout: float = 1.0,
+    ):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.quality = quality
+        self.idle_timeout = idle_timeout
+        self.dropped = 0
+        self._queue = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, name: str, artifacts: dict) -> None:
+        # Never block grading, overlays are dropped when the writer falls behind
+        with self._lock:
+            try:
+                self._queue.put_nowait((name, artifacts))
+            except queue.Full:
+                self.dropped += 1
+                logger.warning(f'Debug queue is full, dropped overlay "{name}".')
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="debug-dumper")
+                self._thread.start()
+
+    def close(self) -> None:
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self) -> None:
+        # The thread stops once idle, so it never keeps a finished process alive
+        while True:
+            try:
+                name, artifacts = self._queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self._lock:
+                    if self._queue.empty():
+                        self._thread = None
+                        return
+                continue
+
+            try:
+                overlay = reader_utils.drawDebugOverlay(**artifacts)
+                cv2.imwrite(
+                    str(self.output_dir / f"{name}.jpg"),
+                    overlay,
+                    [cv2.IMWRITE_JPEG_QUALITY, self.quality],
+                )
+            except Exception as e:
+                logger.exception(e)
+
+
+def copy_artifacts(**artifacts) -> dict:
+    # Reader buffers are overwritten by the next sheet, so hand over copies
+    return {
+        key: value.copy() if isinstance(value, np.ndarray) else value
+        for key, value in artifacts.items()
+    }
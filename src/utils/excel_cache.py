@@ -0,0 +1,141 @@
+import hashlib
+import io
+import json
+import os
+import types
+from pathlib import Path
+from typing import IO, Dict, List, Union
+
+import pandas as pd
+
+from .console import logger
+from .result_cache import file_digest
+
+# Workbooks are converted once into columnar files here, relative to src like
+# the input and output folders
+CACHE_DIR = Path(os.environ.get("EXCEL_CACHE_DIR", "../cache/excel"))
+
+# Bumped whenever converted sheets must be redone, e.g. when a converter
+# changes only through a table it reads
+VERSION = 1
+
+ExcelSource = Union[str, os.PathLike, bytes, IO[bytes]]
+SheetName = Union[str, int]
+
+
+def _hash(value, digest_size: int = 16) -> str:
+    return hashlib.blake2b(value.encode(), digest_size=digest_size).hexdigest()
+
+
+def _const_key(value) -> str:
+    # Nested functions, lambdas and comprehensions are code constants whose
+    # repr holds a memory address, they are keyed by their own code instead
+    if isinstance(value, types.CodeType):
+        consts = ",".join(_const_key(const) for const in value.co_consts)
+        return f"{value.co_code.hex()}:{','.join(value.co_names)}:({consts})"
+    if isinstance(value, tuple):
+        return f"({','.join(_const_key(item) for item in value)})"
+    if isinstance(value, frozenset):
+        return f"{{{','.join(sorted(_const_key(item) for item in value))}}}"
+    return repr(value)
+
+
+def _option_key(value) -> str:
+    # Converters and dtypes are keyed by name so the key is the same in every
+    # process, all lambdas share one name and make poor converters here. The
+    # code of a converter is part of the key, so changing it converts again
+    key = f"{value.__module__}.{value.__qualname__}"
+    code = getattr(value, "__code__", None)
+    if code is not None:
+        key += f":{_hash(_const_key(code), 8)}"
+    return key
+
+
+def _source_key(source: ExcelSource):
+    # A file on disk is keyed by its content and modification time, an upload
+    # only has its content, which is read once and handed on to pandas, and
+    # older copies are only replaced for uploads that have a name
+    if isinstance(source, (str, os.PathLike)):
+        path = Path(source).resolve()
+        version = f"{file_digest(path)}:{path.stat().st_mtime_ns}"
+        return source, _hash(str(path)), _hash(version)
+
+    name = getattr(source, "name", None)
+    if not isinstance(source, bytes):
+        data = source.getvalue() if hasattr(source, "getvalue") else source.read()
+        if hasattr(source, "seek"):
+            source.seek(0)
+    else:
+        data = source
+    version = hashlib.blake2b(data, digest_size=20).hexdigest()
+    return io.BytesIO(data), name and _hash(str(name)), _hash(version)
+
+
+def _evict(cache_dir: Path, prefix: str, version: str, options: str) -> None:
+    # Copies of an older workbook, or read with other options, are not read again
+    stale = [
+        path
+        for path in cache_dir.glob(f"{prefix}-*.parquet")
+        if path.stem.split("-")[1:3] != [version, options]
+    ]
+    for path in stale:
+        path.unlink(missing_ok=True)
+    if len(stale) > 0:
+        logger.info(f"Evicted {len(stale)} stale converted sheets.")
+
+
+def read_excel(
+    source: ExcelSource,
+    sheet_name: Union[SheetName, List[SheetName]] = 0,
+    cache_dir: Union[str, os.PathLike, None] = CACHE_DIR,
+    **kwargs,
+) -> Union[pd.DataFrame, Dict[SheetName, pd.DataFrame]]:
+    # Same as pd.read_excel, but every sheet is parsed from the workbook once
+    # and read back from a Parquet file while the workbook is unchanged
+    if cache_dir is None or sheet_name is None:
+        return pd.read_excel(source, sheet_name=sheet_name, **kwargs)
+
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    source, prefix, version = _source_key(source)
+    options = _hash(
+        json.dumps({"version": VERSION, **kwargs}, sort_keys=True, default=_option_key)
+    )
+
+    sheets = sheet_name if isinstance(sheet_name, list) else [sheet_name]
+    paths = {
+        sheet: cache_dir
+        / f"{prefix or 'upload'}-{version}-{options}-{_hash(repr(sheet), 8)}.parquet"
+        for sheet in sheets
+    }
+
+    frames = {}
+    for sheet, path in paths.items():
+        try:
+            frames[sheet] = pd.read_parquet(path)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable converted sheet {path}: {e}")
+
+    missing = [sheet for sheet in sheets if sheet not in frames]
+    if len(missing) > 0:
+        if prefix is not None:
+            _evict(cache_dir, prefix, version, options)
+        # All missing sheets come from one pass over the workbook
+        parsed = pd.read_excel(source, sheet_name=missing, **kwargs)
+        for sheet in missing:
+            frames[sheet] = parsed[sheet]
+            tmp = paths[sheet].with_suffix(".tmp")
+            try:
+                parsed[sheet].to_parquet(tmp)
+                os.replace(tmp, paths[sheet])
+            except (ImportError, ValueError, TypeError) as e:
+                # Columns mixing numbers and text have no columnar type, such
+                # sheets are simply parsed again next time
+                tmp.unlink(missing_ok=True)
+                logger.warning(f"Sheet {sheet!r} is not cached: {e}")
+
+    if isinstance(sheet_name, list):
+        return {sheet: frames[sheet] for sheet in sheets}
+    return frames[sheet_name]
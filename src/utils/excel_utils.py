@@ -1,5 +1,15 @@
+import functools
+import os
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+import numpy as np
 import pandas as pd
 
+from .excel_cache import read_excel
+
+APDM_PATH = "../../data/database/v2018_muatturun_BEA7619-6.xls"
+
 
 S2I_MAPPINGS = {
     "KELAS KHAS MENENGAH": "0",
@@ -10,6 +20,13 @@ S2I_MAPPINGS = {
     "TINGKATAN LIMA": "5",
 }
 
+APDM_COLUMNS = {
+    "No. KP": "NO. KAD PENGENALAN",
+    "Nama": "NAMA",
+    "Keterangan Tingkatan Tahun": "TINGKATAN",
+    "Nama Kelas": "KELAS",
+}
+
 
 def fix_ic(ic: int):
     try:
@@ -25,27 +42,94 @@ def forms2int(s: str):
     return S2I_MAPPINGS[s]
 
 
-def validate_name(inp_df: pd.DataFrame) -> pd.DataFrame:
-    ref_df = pd.read_excel(
-        "../../data/database/v2018_muatturun_BEA7619-6.xls",
-        converters={
-            "Keterangan Tingkatan Tahun": forms2int,
-            "No. KP": fix_ic,
-            "No. Tel Bimbit Penjaga 1": str,
-            "No. Tel Bimbit Penjaga 2": str,
-        },
-    )
+def _as_series(values: Iterable) -> pd.Series:
+    if isinstance(values, pd.Series):
+        return values
+    return pd.Series(list(values), dtype=object)
+
+
+def normalize_ic(ics: Iterable) -> pd.Series:
+    # Excel keeps ICs as numbers, which loses the leading zero and may add a
+    # trailing ".0", dashes and spaces are dropped as well
+    ics = _as_series(ics).astype("string").str.replace(r"\.0$", "", regex=True)
+    ics = ics.str.replace(r"\D", "", regex=True)
+    return ics.str.zfill(12).where(ics.str.len() > 0).astype(object)
+
+
+def normalize_name(names: Iterable) -> pd.Series:
+    names = _as_series(names).astype("string").str.upper().str.split().str.join(" ")
+    return names.astype(object)
+
+
+class ReferenceIndex:
+    # Student records from APDM, looked up by IC through a hash index
+    def __init__(self, df: pd.DataFrame):
+        df = df[list(APDM_COLUMNS)].rename(columns=APDM_COLUMNS)
+        df = df.assign(**{"NO. KAD PENGENALAN": normalize_ic(df["NO. KAD PENGENALAN"])})
+        df = df.dropna(subset=["NO. KAD PENGENALAN"])
+        df = df.drop_duplicates(subset=["NO. KAD PENGENALAN"])
+        self.records = df.drop(columns="NO. KAD PENGENALAN").reset_index(drop=True)
+        self.ics = pd.Index(df["NO. KAD PENGENALAN"])
+        self.names = normalize_name(self.records["NAMA"]).fillna("").to_numpy()
+
+    @classmethod
+    def from_workbook(cls, path: Union[str, os.PathLike]) -> "ReferenceIndex":
+        return cls(
+            read_excel(
+                path,
+                dtype={"No. KP": str},
+                converters={
+                    "Keterangan Tingkatan Tahun": forms2int,
+                    "No. Tel Bimbit Penjaga 1": str,
+                    "No. Tel Bimbit Penjaga 2": str,
+                },
+            )
+        )
+
+    def __len__(self) -> int:
+        return len(self.ics)
+
+    def positions(self, ics: pd.Series) -> np.ndarray:
+        # Row of every IC in the records, -1 for ICs that are not in APDM
+        return self.ics.get_indexer(normalize_ic(ics))
+
+    def lookup(self, ics: Iterable) -> pd.DataFrame:
+        # NAMA, TINGKATAN and KELAS of every IC, with the same index as the
+        # given ICs and empty for ICs that are not in APDM
+        ics = _as_series(ics)
+        return self.records.reindex(self.positions(ics)).set_axis(ics.index)
+
+    def validate(self, ics: Iterable, names: Optional[Iterable] = None) -> pd.DataFrame:
+        # Whether every IC is in APDM and whether its name matches the record
+        ics = _as_series(ics)
+        positions = self.positions(ics)
+        result = pd.DataFrame({"ADA KP": positions >= 0}, index=ics.index)
+        if names is not None:
+            names = normalize_name(_as_series(names)).fillna("").to_numpy()
+            result["NAMA SAMA"] = result["ADA KP"] & (self.names[positions] == names)
+        return result
+
+
+@functools.lru_cache(maxsize=4)
+def _load_reference(path: str, mtime_ns: int) -> ReferenceIndex:
+    return ReferenceIndex.from_workbook(path)
+
+
+def load_reference(path: Union[str, os.PathLike] = APDM_PATH) -> ReferenceIndex:
+    # Built once per process for every version of the workbook, the workbook
+    # itself is read from its converted copy on disk
+    path = Path(path).resolve()
+    return _load_reference(str(path), path.stat().st_mtime_ns)
+
 
-    ref_df_renamed = ref_df[["Nama", "No. KP"]].rename(columns={"Nama": "NAMA"})
-    inp_df_renamed = inp_df[["NAMA", "NO. KAD PENGENALAN"]].rename(
-        columns={"NO. KAD PENGENALAN": "No. KP"}
-    )
+def validate_name(
+    inp_df: pd.DataFrame, reference: Optional[ReferenceIndex] = None
+) -> pd.DataFrame:
+    if reference is None:
+        reference = load_reference()
 
     # Fix name base on No. KP
-    inp_df_reindexed = inp_df_renamed.set_index("No. KP")
-    ref_df_reindexed = ref_df_renamed.set_index("No. KP")
-    inp_df_reindexed.update(ref_df_reindexed)
-    inp_df_reindexed.reset_index(inplace=True)
-    inp_df["NAMA"] = inp_df_reindexed["NAMA"]
+    names = reference.lookup(inp_df["NO. KAD PENGENALAN"])["NAMA"]
+    inp_df["NAMA"] = names.fillna(inp_df["NAMA"])
 
     return inp_df
@@ -0,0 +1,86 @@
+import os
+import threading
+from typing import List, NamedTuple, Optional
+
+import cv2
+import numpy as np
+
+MULTI_PAGE_EXTENSIONS = (".tif", ".tiff", ".pdf")
+
+# PDF pages are rendered at a resolution that still covers Reader.new_size
+PDF_DPI = 150
+
+# MuPDF keeps global state and must not render from two threads at once
+_pdf_lock = threading.Lock()
+
+
+class Page(NamedTuple):
+    filename: str
+    index: int = 0
+    multi_page: bool = False
+
+    @property
+    def number(self) -> int:
+        return self.index + 1
+
+    @property
+    def name(self) -> str:
+        # Pages of one file need distinct names for logs and debug overlays
+        if not self.multi_page:
+            return self.filename
+        return f"{os.path.splitext(self.filename)[0]}_page{self.number:04d}"
+
+
+def is_multi_page(filename: str) -> bool:
+    return filename.lower().endswith(MULTI_PAGE_EXTENSIONS)
+
+
+def is_pdf(filename: str) -> bool:
+    return filename.lower().endswith(".pdf")
+
+
+def _import_fitz():
+    try:
+        import fitz
+    except ImportError as e:
+        raise ImportError(
+            "Reading PDF scans requires PyMuPDF, install it with "
+            '"pip install pymupdf".'
+        ) from e
+    return fitz
+
+
+def count_pages(filename: str) -> int:
+    if is_pdf(filename):
+        with _pdf_lock, _import_fitz().open(filename) as doc:
+            return doc.page_count
+    return cv2.imcount(filename)
+
+
+def list_pages(filename: str) -> List[Page]:
+    # Only the page count is read here, the pages are decoded one at a time
+    if not is_multi_page(filename):
+        return [Page(filename)]
+    try:
+        n_pages = count_pages(filename)
+    except (cv2.error, ImportError, RuntimeError, ValueError):
+        n_pages = 0
+    # A single page TIFF is decoded like any other image
+    if n_pages <= 1 and not is_pdf(filename):
+        return [Page(filename)]
+    # An unreadable PDF still gets one page, which is then reported as such
+    return [Page(filename, index, True) for index in range(max(n_pages, 1))]
+
+
+def load_page(page: Page, dpi: int = PDF_DPI) -> Optional[np.ndarray]:
+    if is_pdf(page.filename):
+        fitz = _import_fitz()
+        with _pdf_lock, fitz.open(page.filename) as doc:
+            pixmap = doc[page.index].get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+            img = np.frombuffer(pixmap.samples, dtype=np.uint8)
+            return img.reshape(pixmap.height, pixmap.stride)[:, : pixmap.width].copy()
+
+    ok, imgs = cv2.imreadmulti(
+        page.filename, start=page.index, count=1, flags=cv2.IMREAD_GRAYSCALE
+    )
+    return imgs[0] if ok and len(imgs) > 0 else None
@@ -0,0 +1,143 @@
+import cProfile
+import json
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from .console import logger
+
+# Upper bounds in seconds, the last bucket catches everything slower
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class SheetHook:
+    def before_sheet(self, filename: str) -> None:
+        pass
+
+    def after_sheet(self, filename: str, seconds: float) -> None:
+        pass
+
+
+class ProfileHook(SheetHook):
+    def __init__(self, output_dir: Union[str, os.PathLike], min_seconds: float = 0.0):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.min_seconds = min_seconds
+        self.profiler: Optional[cProfile.Profile] = None
+
+    def before_sheet(self, filename: str) -> None:
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def after_sheet(self, filename: str, seconds: float) -> None:
+        self.profiler.disable()
+        # Only keep profiles of the sheets that were slow enough to matter
+        if seconds >= self.min_seconds:
+            stem = Path(os.fsdecode(filename)).stem
+            self.profiler.dump_stats(self.output_dir / f"{stem}.prof")
+        self.profiler = None
+
+
+class StageTimer:
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.stats: Dict[str, dict] = {}
+        self.hooks: List[SheetHook] = []
+        self.last: Dict[str, float] = {}
+
+    def add_hook(self, hook: SheetHook) -> None:
+        self.hooks.append(hook)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float) -> None:
+        # For stages that ran elsewhere, e.g. an image decoded ahead of time
+        self.last[name] = self.last.get(name, 0.0) + seconds
+        self.observe(name, seconds)
+
+    @contextmanager
+    def sheet(self, filename: str, offloaded: float = 0.0) -> Iterator[None]:
+        # offloaded is time spent on this sheet before it got here, like a
+        # decode ahead of time, so total covers the same stages in every mode
+        self.last = {}
+        for hook in self.hooks:
+            hook.before_sheet(filename)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start + offloaded
+            self.last["total"] = seconds
+            self.observe("total", seconds)
+            for hook in reversed(self.hooks):
+                hook.after_sheet(filename, seconds)
+
+    def observe(self, name: str, seconds: float) -> None:
+        stat = self.stats.get(name)
+        if stat is None:
+            stat = {"count": 0, "sum": 0.0, "buckets": [0] * (len(self.buckets) + 1)}
+            self.stats[name] = stat
+        stat["count"] += 1
+        stat["sum"] += seconds
+        stat["buckets"][bisect_left(self.buckets, seconds)] += 1
+
+    def observe_sheet(self, timings: Dict[str, float]) -> None:
+        # Merge the per-sheet timings reported by another process
+        for name, seconds in timings.items():
+            self.observe(name, seconds)
+
+    def to_dict(self) -> dict:
+        return {
+            "buckets": list(self.buckets),
+            "stages": {
+                name: {
+                    "count": stat["count"],
+                    "sum": stat["sum"],
+                    "mean": stat["sum"] / stat["count"],
+                    "histogram": stat["buckets"],
+                }
+                for name, stat in self.stats.items()
+            },
+        }
+
+    def to_prometheus(self, metric: str = "omr_stage_seconds") -> str:
+        lines = [
+            f"# HELP {metric} Wall time of each reader stage per sheet.",
+            f"# TYPE {metric} histogram",
+        ]
+        for name, stat in self.stats.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, stat["buckets"]):
+                cumulative += count
+                lines.append(
+                    f'{metric}_bucket{{stage="{name}",le="{bound}"}} {cumulative}'
+                )
+            lines.append(f'{metric}_bucket{{stage="{name}",le="+Inf"}} {stat["count"]}')
+            lines.append(f'{metric}_sum{{stage="{name}"}} {stat["sum"]}')
+            lines.append(f'{metric}_count{{stage="{name}"}} {stat["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: Union[str, os.PathLike]) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.suffix.lower() == ".json":
+            path.write_text(json.dumps(self.to_dict(), indent=2))
+        else:
+            path.write_text(self.to_prometheus())
+        logger.info(f'Wrote stage timings to "{path}".')
+
+    def log_summary(self) -> None:
+        for name, stat in self.stats.items():
+            logger.info(
+                f"{name:>10}: {stat['sum'] / stat['count'] * 1000:8.2f} ms/sheet "
+                f"over {stat['count']} sheets"
+            )
@@ -1,11 +1,31 @@
 import math
-from typing import List, Union
+from typing import List, NamedTuple, Optional, Tuple, Union
 
 import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 
-from console import logger
+from .console import logger
+
+# Grayscale decode flags by the factor the image is shrunk by while decoding
+REDUCED_GRAYSCALE = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+class CellFill(NamedTuple):
+    scores: np.ndarray
+    fill: np.ndarray
+    confidence: np.ndarray
+
+
+class ScanCheck(NamedTuple):
+    ok: bool
+    reason: str
+    confidence: float
 
 
 def reorder(points: np.ndarray) -> np.ndarray:
@@ -40,6 +60,123 @@ def getCornerPoints(contour: np.ndarray) -> np.ndarray:
     return approx
 
 
+def toGray(img: np.ndarray, dst: Optional[np.ndarray] = None) -> np.ndarray:
+    if len(img.shape) == 2:
+        return img
+    if img.shape[2] == 1:
+        return img[..., 0]
+    code = cv2.COLOR_BGRA2GRAY if img.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+    return cv2.cvtColor(img, code, dst=dst)
+
+
+def to8Bit(img: np.ndarray) -> np.ndarray:
+    if img.dtype == np.uint8:
+        return img
+    return cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+
+
+def reduceFactor(shape: Tuple[int, ...], size: Tuple[int, int]) -> int:
+    # Largest decode reduction that still leaves at least size pixels
+    height, width = shape[:2]
+    factor = 1
+    while (
+        factor < 8 and width >= 2 * factor * size[0] and height >= 2 * factor * size[1]
+    ):
+        factor *= 2
+    return factor
+
+
+def imageShape(source) -> Optional[Tuple[int, int]]:
+    # Height and width from the image header alone, None when Pillow is not
+    # installed or cannot parse the header
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    try:
+        with Image.open(source) as img:
+            return img.height, img.width
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def shrinkImage(
+    img: np.ndarray, size: Tuple[int, int], dst: Optional[np.ndarray] = None
+) -> np.ndarray:
+    # Area averaging sees every source pixel, so the thin outline of the box
+    # survives any ratio, a linear pass would skip it from about 3x down
+    return cv2.resize(img, size, dst=dst, interpolation=cv2.INTER_AREA)
+
+
+def makeThumbnail(img: np.ndarray, width: int = 256) -> np.ndarray:
+    height = max(1, round(img.shape[0] * width / img.shape[1]))
+    return toGray(shrinkImage(img, (width, height)))
+
+
+def precheckScan(
+    img: Optional[np.ndarray],
+    width: int = 256,
+    min_contrast: float = 8.0,
+    max_edge_ratio: float = 0.25,
+    min_box_ratio: float = 0.2,
+) -> ScanCheck:
+    if img is None or img.size == 0:
+        return ScanCheck(False, "unreadable", 1.0)
+
+    thumb = makeThumbnail(img, width)
+    contrast = float(np.std(thumb))
+    if contrast < min_contrast:
+        return ScanCheck(False, "blank", 1 - contrast / min_contrast)
+
+    edges = cv2.Canny(cv2.GaussianBlur(thumb, (5, 5), 1), 10, 50)
+    edge_ratio = cv2.countNonZero(edges) / thumb.size
+    if edge_ratio > max_edge_ratio:
+        confidence = min(1.0, edge_ratio / max_edge_ratio - 1)
+        return ScanCheck(False, "unreadable", confidence)
+
+    # Dilate the edges so the box outline stays closed at thumbnail size
+    edges = cv2.dilate(edges, np.ones((3, 3), np.uint8))
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    rectCon = rectContour(contours, min_area=min_box_ratio * thumb.size)
+    if len(rectCon) == 0:
+        largest = max(map(cv2.contourArea, contours), default=0) / thumb.size
+        confidence = max(0.0, 1 - largest / min_box_ratio)
+        return ScanCheck(False, "no question box", confidence)
+
+    x, y, w, h = cv2.boundingRect(rectCon[0])
+    if x == 0 or y == 0 or x + w >= thumb.shape[1] or y + h >= thumb.shape[0]:
+        return ScanCheck(False, "cropped", 1.0)
+
+    box_ratio = cv2.contourArea(rectCon[0]) / thumb.size
+    confidence = min(contrast / (2 * min_contrast), box_ratio / (2 * min_box_ratio))
+    return ScanCheck(True, "", min(confidence, 1.0))
+
+
+def refineCorners(
+    img: np.ndarray, corners: np.ndarray, scale: Tuple[float, float]
+) -> np.ndarray:
+    # Map pixel centres from the small image back onto the full resolution one
+    points = (corners.reshape(-1, 2) + 0.5) * np.float32(scale) - 0.5
+    points = points.astype(np.float32)
+    if max(scale) <= 1:
+        return points
+
+    radius = 2 * math.ceil(max(scale))
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+    height, width = img.shape[:2]
+    for point in points:
+        x0 = min(max(int(point[0]) - 3 * radius, 0), width - 1)
+        y0 = min(max(int(point[1]) - 3 * radius, 0), height - 1)
+        patch = toGray(img[y0 : y0 + 6 * radius + 1, x0 : x0 + 6 * radius + 1])
+        local = np.float32([[point - (x0, y0)]])
+        cv2.cornerSubPix(patch, local, (radius, radius), (-1, -1), criteria)
+        # Keep the coarse corner if refinement wandered off to another feature
+        if np.all(np.abs(local[0, 0] + (x0, y0) - point) <= radius):
+            point[:] = local[0, 0] + (x0, y0)
+
+    return points
+
+
 def splitBoxes(img: np.ndarray, n_row: int, n_col: int) -> np.ndarray:
     try:
         rows = np.vsplit(img, n_row)
@@ -54,6 +191,127 @@ def splitBoxes(img: np.ndarray, n_row: int, n_col: int) -> np.ndarray:
     return np.array(boxes)
 
 
+def scoreGrid(
+    img: np.ndarray, n_row: int, n_col: int, min_pixel: int = 300
+) -> Tuple[np.ndarray, np.ndarray]:
+    height, width = img.shape[:2]
+    if height % n_row or width % n_col:
+        logger.error(
+            f"Image of size {width}x{height} cannot be split into "
+            f"{n_row} rows and {n_col} columns."
+        )
+        zeros = np.zeros((n_row, n_col), dtype=int)
+        return zeros, zeros.copy()
+
+    # Count the non-zero pixels of every cell in one pass over the image
+    cells = img.reshape(n_row, height // n_row, n_col, width // n_col)
+    pixVal = np.count_nonzero(cells, axis=(1, 3))
+    scores = (pixVal >= min_pixel).astype(int)
+    return scores, pixVal
+
+
+def scoreCells(
+    img: np.ndarray,
+    n_row: int,
+    n_col: int,
+    cutoff: float = 0.3,
+    softness: float = 0.04,
+    ink_range: Tuple[float, float] = (0.05, 0.15),
+    margin: float = 0.15,
+) -> CellFill:
+    height, width = img.shape[:2]
+    secH, secW = height // n_row, width // n_col
+    if height % n_row or width % n_col:
+        logger.error(
+            f"Image of size {width}x{height} cannot be split into "
+            f"{n_row} rows and {n_col} columns."
+        )
+        zeros = np.zeros((n_row, n_col))
+        return CellFill(zeros.astype(int), zeros, zeros.copy())
+
+    # Local paper brightness, a max filter wider than a cell wipes out the marks.
+    # Lighting changes slowly, so it is estimated at a quarter of the size
+    small = cv2.resize(img, (width // 4, height // 4), interpolation=cv2.INTER_AREA)
+    size = max(secH, secW) // 2 + 1
+    background = cv2.dilate(small, np.ones((size, size), np.uint8))
+    background = cv2.blur(background, (size, size))
+    background = cv2.resize(background, (width, height), interpolation=cv2.INTER_LINEAR)
+
+    # Brightness relative to the paper around it, ramped into an ink fraction
+    # from the first hint of darkening to solid ink with a lookup table
+    ratio = cv2.divide(img, background, scale=255)
+    low, high = ink_range
+    ramp = ((1 - low) - np.arange(256) / 255) / (high - low)
+    ink = cv2.LUT(ratio, np.round(np.clip(ramp, 0, 1) * 255).astype(np.uint8))
+
+    # Mean ink of the inner part of every cell, away from printed grid lines
+    cells = ink.reshape(n_row, secH, n_col, secW)
+    mH, mW = round(secH * margin), round(secW * margin)
+    inner = cells[:, mH : secH - mH, :, mW : secW - mW]
+    fill = inner.sum(axis=(1, 3), dtype=np.uint32) / (
+        255 * (secH - 2 * mH) * (secW - 2 * mW)
+    )
+    confidence = 1 / (1 + np.exp(-(fill - cutoff) / softness))
+    return CellFill((fill >= cutoff).astype(int), fill, confidence)
+
+
+def toBGR(img: np.ndarray) -> np.ndarray:
+    if len(img.shape) == 2:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    if img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+    return img.copy()
+
+
+def drawDebugOverlay(
+    imgSmall: np.ndarray,
+    rectCon: Optional[List[np.ndarray]] = None,
+    imgWarped: Optional[np.ndarray] = None,
+    imgThresh: Optional[np.ndarray] = None,
+    pixVal: Optional[np.ndarray] = None,
+    min_pixel: int = 300,
+    reason: str = "",
+) -> np.ndarray:
+    imgCont = toBGR(imgSmall)
+    if rectCon:
+        cv2.drawContours(imgCont, rectCon[:1], -1, (0, 255, 0), 2)
+    panels = [imgCont]
+
+    if imgWarped is not None:
+        panels.append(toBGR(imgWarped))
+
+    # Heatmap of the filled pixels per cell, cells counted as answers are boxed
+    if imgThresh is not None and pixVal is not None:
+        n_row, n_col = pixVal.shape
+        height, width = imgThresh.shape[:2]
+        heat = np.clip(pixVal / (2 * min_pixel) * 255, 0, 255).astype(np.uint8)
+        heat = cv2.resize(heat, (width, height), interpolation=cv2.INTER_NEAREST)
+        heat = cv2.applyColorMap(heat, cv2.COLORMAP_JET)
+        imgHeat = cv2.addWeighted(toBGR(imgThresh), 0.5, heat, 0.5, 0)
+        secH, secW = height // n_row, width // n_col
+        for i in range(1, n_row):
+            cv2.line(imgHeat, (0, secH * i), (width, secH * i), (255, 255, 255), 1)
+        for j in range(1, n_col):
+            cv2.line(imgHeat, (secW * j, 0), (secW * j, height), (255, 255, 255), 1)
+        for i, j in np.argwhere(pixVal >= min_pixel):
+            pt1 = (secW * j + 2, secH * i + 2)
+            pt2 = (secW * (j + 1) - 2, secH * (i + 1) - 2)
+            cv2.rectangle(imgHeat, pt1, pt2, (255, 255, 255), 2)
+        panels.append(imgHeat)
+
+    height = max(panel.shape[0] for panel in panels)
+    panels = [
+        cv2.resize(panel, (round(panel.shape[1] * height / panel.shape[0]), height))
+        for panel in panels
+    ]
+    overlay = np.hstack(panels)
+    if reason:
+        cv2.putText(
+            overlay, reason, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2
+        )
+    return overlay
+
+
 def drawGrid(img: np.ndarray, questions: int = 5, choices: int = 5) -> np.ndarray:
     secW = int(img.shape[1] / questions)
     secH = int(img.shape[0] / choices)
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from .console import logger
+
+# Bumped whenever the stored results change shape, older entries are evicted
+SCHEMA = 2
+
+# Results that have not been used for this long are evicted, in seconds
+MAX_AGE = 90 * 24 * 3600
+
+
+def file_digest(filename: Union[str, os.PathLike], chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    with open(filename, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    def __init__(
+        self, path: Union[str, os.PathLike], config: dict, commit_every: int = 100
+    ):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.config_key = hashlib.blake2b(
+            json.dumps({"schema": SCHEMA, **config}, sort_keys=True).encode(),
+            digest_size=16,
+        ).hexdigest()
+        self.commit_every = commit_every
+        self._pending = 0
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "digest TEXT NOT NULL, config TEXT NOT NULL, filename TEXT NOT NULL, "
+            "result TEXT NOT NULL, updated REAL NOT NULL, "
+            "PRIMARY KEY (digest, config))"
+        )
+        self.conn.commit()
+
+    def __enter__(self) -> "ResultCache":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def get(self, digest: str) -> Optional[List[dict]]:
+        row = self.conn.execute(
+            "SELECT result FROM results WHERE digest = ? AND config = ?",
+            (digest, self.config_key),
+        ).fetchone()
+        if row is None:
+            return None
+        # Results in use are kept fresh, so only abandoned ones age out
+        self.conn.execute(
+            "UPDATE results SET updated = ? WHERE digest = ? AND config = ?",
+            (time.time(), digest, self.config_key),
+        )
+        self._pending += 1
+        return json.loads(row[0])
+
+    def put(self, digest: str, filename: str, results: List[dict]) -> None:
+        # A file is stored with the results of all of its pages, in page order
+        self.conn.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+            (digest, self.config_key, filename, json.dumps(results), time.time()),
+        )
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def commit(self) -> None:
+        self.conn.commit()
+        self._pending = 0
+
+    def evict(self, current: Dict[str, str], max_age: float = MAX_AGE) -> int:
+        # Drop results of files in this run whose content has changed since
+        # they were graded, under any reader configuration, and results that
+        # have not been used for max_age. Other configurations keep theirs, so
+        # switching back and forth does not regrade everything
+        evicted = self.conn.executemany(
+            "DELETE FROM results WHERE filename = ? AND digest != ?",
+            list(current.items()),
+        ).rowcount
+        evicted += self.conn.execute(
+            "DELETE FROM results WHERE updated < ?", (time.time() - max_age,)
+        ).rowcount
+        self.commit()
+        if evicted > 0:
+            logger.info(f'Evicted {evicted} stale results from "{self.path}".')
+        return evicted
+
+    def close(self) -> None:
+        self.commit()
+        self.conn.close()
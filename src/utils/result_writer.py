@@ -0,0 +1,121 @@
+import csv
+import json
+import os
+from pathlib import Path
+from typing import List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from .console import logger
+
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".parquet": "parquet"}
+
+
+def get_format(path: Union[str, os.PathLike]) -> str:
+    suffix = Path(path).suffix.lower()
+    if suffix not in FORMATS:
+        raise ValueError(
+            f'Unsupported result format "{suffix}", use one of {", ".join(FORMATS)}.'
+        )
+    return FORMATS[suffix]
+
+
+def is_result_file(path: Union[str, os.PathLike]) -> bool:
+    return Path(path).suffix.lower() in FORMATS
+
+
+def _to_builtin(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class ResultWriter:
+    def __init__(
+        self, path: Union[str, os.PathLike], chunk_size: int = 100, append: bool = False
+    ):
+        self.path = Path(path)
+        self.format = get_format(path)
+        self.chunk_size = chunk_size
+        self.count = 0
+        self._chunk: List[dict] = []
+        self._fieldnames: Optional[List[str]] = None
+        self._part = 0
+
+        # Parquet files are only readable once closed, so every chunk becomes
+        # its own part file inside a dataset directory
+        if self.format == "parquet":
+            self.path.mkdir(parents=True, exist_ok=True)
+            parts = sorted(self.path.glob("part-*.parquet"))
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        # A run replaces the results of the previous one unless told to add to
+        # them, chunks are still written as they come so a crash leaves the
+        # results so far readable
+        if append:
+            self._part = len(parts) if self.format == "parquet" else 0
+        elif self.format == "parquet":
+            for part in parts:
+                part.unlink()
+        else:
+            self.path.unlink(missing_ok=True)
+
+    def __enter__(self) -> "ResultWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def write(self, record: dict) -> None:
+        self._chunk.append(record)
+        if len(self._chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._chunk:
+            return
+
+        if self.format == "csv":
+            self._write_csv()
+        elif self.format == "jsonl":
+            with self.path.open("a", encoding="utf-8") as f:
+                for record in self._chunk:
+                    f.write(json.dumps(record, default=_to_builtin) + "\n")
+        else:
+            part = self.path / f"part-{self._part:05d}.parquet"
+            pd.DataFrame(self._chunk).to_parquet(part, index=False)
+            self._part += 1
+
+        self.count += len(self._chunk)
+        self._chunk = []
+
+    def close(self) -> None:
+        self.flush()
+        logger.info(f'Wrote {self.count} results to "{self.path}".')
+
+    def _write_csv(self) -> None:
+        new_file = not self.path.exists() or self.path.stat().st_size == 0
+        if self._fieldnames is None:
+            if new_file:
+                self._fieldnames = list(self._chunk[0].keys())
+            else:
+                with self.path.open(newline="", encoding="utf-8") as f:
+                    self._fieldnames = next(csv.reader(f))
+
+        with self.path.open("a", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, self._fieldnames, extrasaction="ignore")
+            if new_file:
+                writer.writeheader()
+            writer.writerows(self._chunk)
+
+
+def read_results(path: Union[str, os.PathLike]) -> pd.DataFrame:
+    result_format = get_format(path)
+    if result_format == "csv":
+        return pd.read_csv(path)
+    elif result_format == "jsonl":
+        return pd.read_json(path, lines=True)
+    else:
+        return pd.read_parquet(path)
@@ -0,0 +1,85 @@
+from typing import List, Optional
+
+import cv2
+import numpy as np
+
+A4_INCH = (8.27, 11.69)
+
+
+def random_answers(
+    n_rows: int,
+    n_cols: int,
+    drop_row: List[int],
+    drop_col: List[int],
+    rng: Optional[np.random.Generator] = None,
+    blank_rate: float = 0.0,
+    double_rate: float = 0.0,
+) -> np.ndarray:
+    rng = rng or np.random.default_rng()
+    keep_row = np.setdiff1d(np.arange(n_rows), drop_row)
+    pairs = np.setdiff1d(np.arange(n_cols), drop_col).reshape(-1, 2)
+
+    truth = np.zeros((n_rows, n_cols), dtype=int)
+    choice = rng.integers(0, 2, (len(keep_row), len(pairs)))
+    truth[keep_row[:, None], pairs[np.arange(len(pairs)), choice]] = 1
+
+    # Some questions are left blank or answered twice on purpose
+    mark = rng.random((len(keep_row), len(pairs)))
+    for column in range(2):
+        cols = pairs[:, column]
+        truth[keep_row[:, None], cols] *= mark >= blank_rate
+        truth[keep_row[:, None], cols] |= mark >= 1 - double_rate
+    return truth
+
+
+def generate_sheet(
+    truth: np.ndarray,
+    drop_row: List[int],
+    drop_col: List[int],
+    dpi: int = 300,
+    rotation: float = 0.0,
+    skew: float = 0.0,
+    noise: float = 0.0,
+    rng: Optional[np.random.Generator] = None,
+) -> np.ndarray:
+    rng = rng or np.random.default_rng()
+    n_rows, n_cols = truth.shape
+    width, height = round(A4_INCH[0] * dpi), round(A4_INCH[1] * dpi)
+    img = np.full((height, width, 3), 235, dtype=np.uint8)
+
+    # Question box, with a bubble for every cell that is not dropped
+    x0, y0, x1, y1 = 0.1 * width, 0.14 * height, 0.9 * width, 0.94 * height
+    thickness = max(2, round(dpi / 100))
+    cv2.rectangle(
+        img, (round(x0), round(y0)), (round(x1), round(y1)), (0, 0, 0), thickness
+    )
+    cell_w, cell_h = (x1 - x0) / n_cols, (y1 - y0) / n_rows
+    radius = round(0.38 * min(cell_w, cell_h))
+    # Pencil marks usually spill a little over the printed bubble
+    mark_radius = round(0.40 * min(cell_w, cell_h))
+    for row in range(n_rows):
+        for col in range(n_cols):
+            center = (
+                round(x0 + (col + 0.5) * cell_w),
+                round(y0 + (row + 0.5) * cell_h),
+            )
+            if truth[row, col]:
+                cv2.circle(img, center, mark_radius, (30, 30, 30), -1)
+            elif row not in drop_row and col not in drop_col:
+                cv2.circle(img, center, radius, (150, 150, 150), thickness // 2)
+
+    # Rotate about the centre, then move each page corner by up to skew * width
+    if rotation or skew:
+        corners = np.float32([[0, 0], [width, 0], [0, height], [width, height]])
+        rotate = cv2.getRotationMatrix2D((width / 2, height / 2), rotation, 1.0)
+        moved = cv2.transform(corners[None], rotate)[0]
+        moved += rng.uniform(-skew, skew, (4, 2)).astype(np.float32) * width
+        matrix = cv2.getPerspectiveTransform(corners, moved)
+        img = cv2.warpPerspective(
+            img, matrix, (width, height), borderValue=(235, 235, 235)
+        )
+
+    if noise:
+        img = np.clip(img + rng.normal(0, noise, img.shape), 0, 255).astype(np.uint8)
+
+    return img
@@ -0,0 +1,49 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Set, Union
+
+
+def payload_digest(payload: dict) -> str:
+    return hashlib.blake2b(
+        json.dumps(payload, sort_keys=True, default=str).encode(), digest_size=16
+    ).hexdigest()
+
+
+class UploadJournal:
+    # Records every payload the server has accepted, so a re-run only sends
+    # records that are new or whose marks have changed since
+    def __init__(self, path: Union[str, os.PathLike]):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS uploads ("
+            "record TEXT NOT NULL, digest TEXT NOT NULL, uploaded REAL NOT NULL, "
+            "PRIMARY KEY (record))"
+        )
+        self.conn.commit()
+
+    def __enter__(self) -> "UploadJournal":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def uploaded(self) -> Set[tuple]:
+        return set(self.conn.execute("SELECT record, digest FROM uploads"))
+
+    def put(self, record: str, digest: str) -> None:
+        # Committed straight away, an interrupted run must not upload it again
+        self.conn.execute(
+            "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?)",
+            (record, digest, time.time()),
+        )
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
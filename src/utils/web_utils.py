@@ -1,11 +1,18 @@
 import os
+import threading
+import time
 from typing import Optional
 
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from .console import logger
 
+# Overridden to point every client at a local stand-in server for testing
+BASE_URL = os.environ.get("EPKM_URL", "https://epkm.moe.gov.my").rstrip("/")
+
 
 def init_user():
     unm = input("Sila masukkan nama pengguna SEPKM: ")
@@ -14,7 +21,46 @@ def init_user():
         f.write(f"namapengguna={unm}\nkatalaluan={pwd}")
 
 
-def create_session() -> Optional[requests.Session]:
+def pool_session(
+    session: requests.Session,
+    pool_size: int = 8,
+    retries: int = 3,
+    backoff: float = 0.5,
+    methods: Optional[frozenset] = None,
+) -> requests.Session:
+    # One pool of connections shared by all worker threads, failed requests
+    # and overloaded responses are retried with exponential backoff
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=methods or Retry.DEFAULT_ALLOWED_METHODS,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class RateLimiter:
+    # Spaces out requests from all threads to at most rate per second
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+
+def create_session(base_url: str = BASE_URL) -> Optional[requests.Session]:
     if not os.path.exists(".env"):
         init_user()
     load_dotenv(".env")
@@ -25,9 +71,7 @@ def create_session() -> Optional[requests.Session]:
         "sbtMasuk": "MASUK",
     }
 
-    resp = session.post(
-        "https://epkm.moe.gov.my/guru/proses.php", data=login_data, verify=False
-    )
+    resp = session.post(f"{base_url}/guru/proses.php", data=login_data, verify=False)
     if resp.status_code == 200:
         logger.info("Telah berjaya log masuk ke SEPKM.")
         return session